@@ -0,0 +1,274 @@
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from types import MappingProxyType, SimpleNamespace
+from unittest.mock import Mock, patch
+
+import pytest
+
+# Deployed functions receive FIREBASE_CONFIG; the storage trigger needs its bucket
+os.environ.setdefault('FIREBASE_CONFIG', json.dumps({
+    'projectId': 'test-project',
+    'storageBucket': 'test-project.appspot.com'
+}))
+
+# Any Firestore call that slips past a mock fails fast against a local address
+# instead of reaching a real project
+os.environ.setdefault('FIRESTORE_EMULATOR_HOST', 'localhost:8080')
+
+from main import app
+
+@pytest.fixture(scope='session')
+def client():
+    """Flask test client shared by the whole session; it keeps no per-test state"""
+    app.config['TESTING'] = True
+    return app.test_client()
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Reset in-process caches so state never leaks between tests"""
+    import main
+    main._auth_cache.clear()
+    main._service_cache.clear()
+    main._service_list_cache.clear()
+    main._site_settings_cache.clear()
+    main._page_content_cache.clear()
+    main._content_version_cache.clear()
+    main._legacy_notifications_drained.clear()
+    yield
+
+@pytest.fixture(autouse=True)
+def mock_db():
+    """Mock Firestore database, patched for every test so none reaches a real project"""
+    with patch('main.db') as mock:
+        yield mock
+
+@pytest.fixture
+def firestore_doc():
+    """Build read-only document snapshots; firestore_doc(None) is a missing document"""
+    def make(data, doc_id=None):
+        return SimpleNamespace(exists=data is not None, id=doc_id, to_dict=lambda: data,
+                               reference=SimpleNamespace(id=doc_id))
+    return make
+
+@pytest.fixture
+def mock_auth():
+    """Mock Firebase Auth"""
+    with patch('main.auth') as mock:
+        yield mock
+
+@pytest.fixture
+def mock_validate():
+    """Mock ID token verification"""
+    with patch('main.validate_auth_token') as mock:
+        yield mock
+
+@pytest.fixture
+def mock_storage():
+    """Mock Firebase Storage"""
+    with patch('main.get_bucket') as mock:
+        yield mock.return_value
+
+@pytest.fixture
+def valid_auth_token():
+    """Mock valid auth token"""
+    return "valid_token_123"
+
+@pytest.fixture
+def mock_user_data():
+    """Mock user data"""
+    return {
+        'uid': 'user123',
+        'email': 'test@example.com',
+        'role': 'client',
+        'profile': {
+            'firstName': 'John',
+            'lastName': 'Doe',
+            'phone': '+1234567890'
+        },
+        'preferences': {
+            'notificationMethod': 'email',
+            'reminderSettings': {
+                'email': True,
+                'sms': False,
+                'hoursBefore': [24, 2]
+            }
+        }
+    }
+
+@pytest.fixture
+def mock_admin_user_data():
+    """Mock admin user data"""
+    return {
+        'uid': 'admin123',
+        'email': 'admin@example.com',
+        'role': 'admin',
+        'profile': {
+            'firstName': 'Admin',
+            'lastName': 'User'
+        }
+    }
+
+@pytest.fixture
+def mock_service_data():
+    """Mock service package data"""
+    return {
+        'id': 'service123',
+        'name': 'Classic Lashes',
+        'description': 'Natural-looking individual lash extensions',
+        'price': 120,
+        'durationMinutes': 120,
+        'category': 'classic',
+        'features': ['1:1 ratio', 'Natural look', 'Lasting 4-6 weeks'],
+        'isFeatured': True,
+        'displayOrder': 1,
+        'isActive': True
+    }
+
+@pytest.fixture
+def mock_appointment_data():
+    """Mock appointment data"""
+    return {
+        'id': 'appointment123',
+        'client': {
+            'id': 'user123',
+            'name': 'John Doe',
+            'email': 'test@example.com',
+            'phone': '+1234567890'
+        },
+        'service': {
+            'id': 'service123',
+            'name': 'Classic Lashes',
+            'price': 120,
+            'duration': 120
+        },
+        'dateTime': {
+            'date': datetime.now(timezone.utc) + timedelta(days=1),
+            'time': '14:00',
+            'timezone': 'UTC'
+        },
+        'status': 'confirmed',
+        'payment': {
+            'status': 'pending',
+            'totalPrice': 120
+        }
+    }
+
+_REQUEST_PAYLOADS = {
+    'create_user': {
+        'email': 'newuser@example.com',
+        'password': 'password123',
+        'role': 'client',
+        'profile': {
+            'firstName': 'New',
+            'lastName': 'User'
+        }
+    },
+    'create_service': {
+        'name': 'Volume Lashes',
+        'description': 'Fuller, more dramatic lash extensions',
+        'price': 180,
+        'durationMinutes': 150,
+        'category': 'volume'
+    },
+    'create_appointment': {
+        'clientId': 'user123',
+        'serviceId': 'service123',
+        'dateTime': '2024-12-15T14:00:00Z'
+    },
+    'update_appointment': {
+        'status': 'completed',
+        'statusNote': 'Service completed successfully'
+    },
+    'create_testimonial': {
+        'clientName': 'John Doe',
+        'rating': 5,
+        'reviewText': 'Excellent service!',
+        'serviceReceived': 'Classic Lashes'
+    }
+}
+
+@lru_cache(maxsize=None)
+def _payload(kind):
+    return MappingProxyType(_REQUEST_PAYLOADS[kind])
+
+@pytest.fixture
+def request_payload():
+    """Read-only request bodies by kind; pass dict(...) as json=, extending it if needed"""
+    return _payload
+
+@pytest.fixture
+def stored_docs(mock_db, firestore_doc):
+    """Serve mock_db document reads from {doc_id: data}; unknown IDs are missing
+    documents and document() with no ID is a new reference called new_id"""
+    def install(docs, new_id='new123'):
+        snapshots = {doc_id: firestore_doc(data, doc_id) for doc_id, data in docs.items()}
+        refs = {}
+        for doc_id, snapshot in snapshots.items():
+            # Each stored snapshot's reference reads back that snapshot
+            snapshot.reference = refs[doc_id] = Mock(id=doc_id, get=Mock(return_value=snapshot))
+        
+        def document(doc_id=None):
+            if doc_id is None:
+                return Mock(id=new_id)
+            return refs.get(doc_id) or Mock(id=doc_id, get=Mock(return_value=firestore_doc(None, doc_id)))
+        
+        mock_db.collection.return_value.document.side_effect = document
+        return snapshots
+    return install
+
+class FakeQuery:
+    """Chainable stand-in for a Firestore query: records how it was built and
+    streams preset documents"""
+    
+    def __init__(self, docs):
+        self.docs = docs
+        self.filters = []
+        self.order = []
+        self.limits = []
+        self.streams = 0
+    
+    def where(self, field, op, value):
+        self.filters.append((field, op, value))
+        return self
+    
+    def order_by(self, field, direction=None):
+        self.order.append(field)
+        return self
+    
+    def limit(self, count):
+        self.limits.append(count)
+        return self
+    
+    def stream(self):
+        self.streams += 1
+        return iter(self.docs)
+
+@pytest.fixture
+def stored_query(mock_db):
+    """Answer mock_db collection queries with a FakeQuery streaming docs"""
+    def install(docs):
+        query = FakeQuery(docs)
+        collection = mock_db.collection.return_value
+        collection.where.side_effect = query.where
+        collection.order_by.side_effect = query.order_by
+        return query
+    return install
+
+def _sign_in(mock_db, mock_validate, firestore_doc, uid, user_data):
+    # require_auth reads users/<uid> through the same mock chain the tests use
+    mock_validate.return_value = {'success': True, 'user': {'uid': uid}}
+    mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(user_data)
+
+@pytest.fixture
+def authenticated_client(client, mock_db, mock_validate, firestore_doc, mock_user_data):
+    """(client, mock_db, mock_validate) signed in as the client user123"""
+    _sign_in(mock_db, mock_validate, firestore_doc, 'user123', mock_user_data)
+    return client, mock_db, mock_validate
+
+@pytest.fixture
+def admin_authenticated_client(client, mock_db, mock_validate, firestore_doc, mock_admin_user_data):
+    """(client, mock_db, mock_validate) signed in as admin123"""
+    _sign_in(mock_db, mock_validate, firestore_doc, 'admin123', mock_admin_user_data)
+    return client, mock_db, mock_validate
@@ -1,38 +1,159 @@
-import json
+import functools
+import hashlib
+import html
+import itertools
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Any
-import pytz
-from dateutil import parser
-import stripe
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
-from twilio.rest import Client as TwilioClient
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple, Any
+from cachetools import TTLCache
+import orjson
+import fastjsonschema
 
 import firebase_admin
-from firebase_admin import credentials, firestore, auth, storage
-from firebase_functions import https_fn, scheduler_fn
-from flask import Flask, request, jsonify
-from flask_cors import CORS
+from firebase_admin import firestore, auth, storage
+from google.api_core.exceptions import AlreadyExists
+from google.cloud.firestore_v1.field_path import FieldPath
+from firebase_functions import https_fn, scheduler_fn, storage_fn
+from flask import Flask, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.utils import secure_filename
 
 # Initialize Firebase Admin SDK
 if not firebase_admin._apps:
     firebase_admin.initialize_app()
 
-db = firestore.client()
-bucket = storage.bucket()
+# gRPC shares connections between channels with identical arguments through a
+# global subchannel pool; a local pool gives every pooled client its own connection.
+FIRESTORE_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', 30000),
+    ('grpc.use_local_subchannel_pool', 1),
+]
+
+class PooledFirestoreClient(firestore.Client):
+    """Firestore client whose gRPC channel never shares a connection with other clients"""
+
+    def _firestore_api_helper(self, transport, client_class, client_module):
+        if self._firestore_api_internal is None and self._emulator_host is None:
+            channel = transport.create_channel(
+                self._target,
+                credentials=self._credentials,
+                options=FIRESTORE_CHANNEL_OPTIONS,
+            )
+            self._transport = transport(host=self._target, channel=channel)
+            self._firestore_api_internal = client_class(
+                transport=self._transport, client_options=self._client_options
+            )
+            client_module._client_info = self._client_info
+        return super()._firestore_api_helper(transport, client_class, client_module)
+
+class FirestoreClientPool:
+    """Thread-affine pool of Firestore clients.
+
+    Each client owns its own gRPC connection, so spreading worker threads across
+    several clients keeps concurrent handlers from queuing on a single connection.
+    Threads are assigned a client round-robin on first use and keep it, so a
+    single-threaded instance only ever uses one client. Attribute access is
+    delegated to the calling thread's client, which keeps call sites as
+    ``db.collection(...)``. Clients are created on first use.
+    """
+
+    def __init__(self, size: int):
+        self._clients: List[Optional[Any]] = [None] * size
+        self._slots = itertools.count()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _create_client(self):
+        firebase_app = firebase_admin.get_app()
+        return PooledFirestoreClient(
+            project=firebase_app.project_id,
+            credentials=firebase_app.credential.get_credential()
+        )
+
+    def client(self):
+        """Return the Firestore client assigned to the current thread"""
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            slot = next(self._slots) % len(self._clients)
+            with self._lock:
+                if self._clients[slot] is None:
+                    self._clients[slot] = self._create_client()
+                client = self._clients[slot]
+            self._local.client = client
+        return client
+
+    def __getattr__(self, name):
+        # Introspection (e.g. mock.patch probing dunders) must not create clients
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.client(), name)
+
+FIRESTORE_POOL_SIZE = 4
+db = FirestoreClientPool(FIRESTORE_POOL_SIZE)
+
+@functools.lru_cache(maxsize=None)
+def get_bucket():
+    """Return the default Cloud Storage bucket, resolved on first use"""
+    return storage.bucket()
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson.
+
+    Dates and other types orjson doesn't handle natively fall through to
+    Flask's default hook, so the wire format matches the stdlib provider.
+    Keys are always sorted and output is always compact: stdlib keyword
+    arguments such as ``sort_keys`` or ``indent`` are accepted but ignored.
+    """
+    options = orjson.OPT_SORT_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj, default=self.default, option=self.options).decode()
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return orjson.loads(s)
+
+    def response(self, *args: Any, **kwargs: Any):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self.options)
+        return self._app.response_class(body, mimetype=self.mimetype)
 
 # Initialize Flask app for routing
 app = Flask(__name__)
-CORS(app)
+app.json = OrjsonProvider(app)
+
+# Any origin may call the API; auth is by bearer token, never cookies
+CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Authorization, Content-Type',
+    'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
+    'Access-Control-Max-Age': '3600',
+}
+
+@app.after_request
+def add_cors_headers(response):
+    response.headers.update(CORS_HEADERS)
+    return response
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shared worker pool for issuing independent Firestore reads concurrently
+executor = ThreadPoolExecutor(max_workers=8)
+
 # Utility functions
-def get_current_timestamp():
-    return datetime.utcnow()
+def get_current_timestamp() -> datetime:
+    return datetime.now(timezone.utc)
+
+def parse_iso_datetime(value: str) -> datetime:
+    """Parse an ISO 8601 timestamp, accepting a trailing 'Z' for UTC"""
+    if value.endswith('Z'):
+        value = value[:-1] + '+00:00'
+    return datetime.fromisoformat(value)
 
 def validate_auth_token(token: str) -> Dict[str, Any]:
     """Validate Firebase Auth token and return user info"""
@@ -42,38 +163,144 @@ def validate_auth_token(token: str) -> Dict[str, Any]:
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+# Verified ID tokens keyed by token digest -> (expiresAt, decoded token, role, user data).
+# Entries never outlive the token's own `exp` claim.
+AUTH_CACHE_TTL_SECONDS = 300
+_auth_cache = TTLCache(maxsize=10000, ttl=AUTH_CACHE_TTL_SECONDS)
+_auth_cache_lock = threading.Lock()
+
+def _auth_cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+def invalidate_cached_auth(user_id: str):
+    """Drop cached auth entries for a user whose document has changed"""
+    with _auth_cache_lock:
+        stale_keys = [key for key, (_, decoded_token, _, _) in _auth_cache.items()
+                      if decoded_token.get('uid') == user_id]
+        for key in stale_keys:
+            _auth_cache.pop(key, None)
+
+def stream_documents(key: str, docs, error_message: str) -> Response:
+    """Stream documents as {"success": true, key: [...]} while Firestore yields them.
+
+    The first document is read before the response starts, so query errors
+    still surface in the caller's error handling instead of mid-stream. A
+    failure after that is logged with ``error_message`` and re-raised, which
+    aborts the response rather than ending it with truncated JSON.
+    """
+    docs = iter(docs)
+    first_doc = next(docs, None)
+    
+    def generate():
+        yield f'{{"success": true, "{key}": ['
+        try:
+            if first_doc is not None:
+                for index, doc in enumerate(itertools.chain([first_doc], docs)):
+                    doc_data = doc.to_dict()
+                    doc_data['id'] = doc.id
+                    yield (',' if index else '') + app.json.dumps(doc_data)
+        except Exception as e:
+            logger.error(f"{error_message}: {str(e)}")
+            raise
+        yield ']}'
+    
+    return Response(generate(), status=200, mimetype='application/json')
+
+# Public GETs may be cached by browsers and the CDN, then revalidated by ETag
+PUBLIC_CACHE_CONTROL = 'public, max-age=60, stale-while-revalidate=300'
+
+def cacheable_response(body: str) -> Response:
+    """Build a publicly cacheable JSON response, answering 304 on a matching If-None-Match"""
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['Cache-Control'] = PUBLIC_CACHE_CONTROL
+    response.add_etag()
+    return response.make_conditional(request)
+
+# Fixed error bodies on the auth path, serialized once. Each call still gets its
+# own Response, since after_request hooks mutate headers.
+ERROR_MISSING_AUTH = (orjson.dumps({"error": "Missing or invalid authorization header"}), 401)
+ERROR_INVALID_TOKEN = (orjson.dumps({"error": "Invalid token"}), 401)
+ERROR_INSUFFICIENT_PERMISSIONS = (orjson.dumps({"error": "Insufficient permissions"}), 403)
+ERROR_ACCESS_DENIED = (orjson.dumps({"error": "Access denied"}), 403)
+ERROR_USER_NOT_FOUND = (orjson.dumps({"error": "User not found"}), 404)
+
+def error_response(error) -> Response:
+    """Build a JSON error response from a pre-serialized (body, status) pair"""
+    body, status = error
+    return app.response_class(body, status=status, mimetype='application/json')
+
+BEARER_PREFIX = 'Bearer '
+
 def require_auth(required_roles: List[str] = None):
     """Decorator to require authentication and optionally specific roles"""
+    allowed_roles = frozenset(required_roles or ())
+    
     def decorator(func):
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             auth_header = request.headers.get('Authorization')
-            if not auth_header or not auth_header.startswith('Bearer '):
-                return jsonify({"error": "Missing or invalid authorization header"}), 401
-            
-            token = auth_header.split(' ')[1]
-            auth_result = validate_auth_token(token)
+            if not auth_header or not auth_header.startswith(BEARER_PREFIX):
+                return error_response(ERROR_MISSING_AUTH)
             
-            if not auth_result["success"]:
-                return jsonify({"error": "Invalid token"}), 401
-            
-            # Get user role from Firestore
-            user_doc = db.collection('users').document(auth_result["user"]["uid"]).get()
-            if not user_doc.exists:
-                return jsonify({"error": "User not found"}), 404
+            token = auth_header[len(BEARER_PREFIX):]
+            cache_key = _auth_cache_key(token)
+            with _auth_cache_lock:
+                cached = _auth_cache.get(cache_key)
             
-            user_data = user_doc.to_dict()
-            user_role = user_data.get('role', 'client')
+            if cached and cached[0] > time.time():
+                _, decoded_token, user_role, user_data = cached
+            else:
+                auth_result = validate_auth_token(token)
+                
+                if not auth_result["success"]:
+                    return error_response(ERROR_INVALID_TOKEN)
+                
+                decoded_token = auth_result["user"]
+                user_role = decoded_token.get('role')
+                user_data = None
+                
+                # A client claim is trusted as-is. Elevated claims may be stale
+                # after a demotion, and tokens issued before role claims carry
+                # none, so both are confirmed against the user document.
+                if user_role != 'client':
+                    user_doc = db.collection('users').document(decoded_token["uid"]).get()
+                    if not user_doc.exists:
+                        return error_response(ERROR_USER_NOT_FOUND)
+                    
+                    user_data = user_doc.to_dict()
+                    user_role = user_data.get('role', 'client')
+                
+                expires_at = decoded_token.get('exp', 0)
+                if expires_at > time.time():
+                    with _auth_cache_lock:
+                        _auth_cache[cache_key] = (expires_at, decoded_token, user_role, user_data)
             
-            if required_roles and user_role not in required_roles:
-                return jsonify({"error": "Insufficient permissions"}), 403
+            if allowed_roles and user_role not in allowed_roles:
+                return error_response(ERROR_INSUFFICIENT_PERMISSIONS)
             
-            # Add user info to request context
-            request.user_id = auth_result["user"]["uid"]
+            # Add user info to request context; user_data is None when the
+            # role came from the token alone
+            request.user_id = decoded_token["uid"]
             request.user_role = user_role
             request.user_data = user_data
             
             return func(*args, **kwargs)
-        wrapper.__name__ = func.__name__
+        return wrapper
+    return decorator
+
+def validate_json(schema: Dict):
+    """Decorator to validate the JSON request body against a schema compiled at import"""
+    validate = fastjsonschema.compile(schema)
+    
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                validate(request.get_json(silent=True))
+            except fastjsonschema.JsonSchemaException as e:
+                return jsonify({"error": e.message}), 400
+            
+            return func(*args, **kwargs)
         return wrapper
     return decorator
 
@@ -81,11 +308,34 @@ def require_auth(required_roles: List[str] = None):
 # USER MANAGEMENT ENDPOINTS
 # =============================================================================
 
+USER_UPDATE_FIELDS = ('profile', 'preferences', 'medicalInfo')
+ADMIN_USER_UPDATE_FIELDS = USER_UPDATE_FIELDS + ('role', 'isActive')
+
+CREATE_USER_SCHEMA = {
+    'type': 'object',
+    'required': ['email', 'password', 'profile'],
+    'properties': {
+        'email': {'type': 'string', 'minLength': 3},
+        'password': {'type': 'string', 'minLength': 6},
+        'profile': {
+            'type': 'object',
+            'required': ['firstName', 'lastName'],
+            'properties': {
+                'firstName': {'type': 'string'},
+                'lastName': {'type': 'string'}
+            }
+        },
+        'role': {'type': 'string', 'enum': ['client', 'technician', 'admin']}
+    }
+}
+
 @app.route('/api/users', methods=['POST'])
 @require_auth(['admin'])
+@validate_json(CREATE_USER_SCHEMA)
 def create_user():
     """Create a new user account"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
         # Create Firebase Auth user
@@ -96,9 +346,12 @@ def create_user():
         )
         
         # Create user document in Firestore
+        role = data.get('role', 'client')
+        auth.set_custom_user_claims(user_record.uid, {'role': role})
+        
         user_data = {
             'email': data['email'],
-            'role': data.get('role', 'client'),
+            'role': role,
             'profile': data.get('profile', {}),
             'preferences': data.get('preferences', {
                 'notificationMethod': 'email',
@@ -111,8 +364,8 @@ def create_user():
             }),
             'medicalInfo': data.get('medicalInfo', {}),
             'isActive': True,
-            'createdAt': get_current_timestamp(),
-            'updatedAt': get_current_timestamp()
+            'createdAt': now,
+            'updatedAt': now
         }
         
         db.collection('users').document(user_record.uid).set(user_data)
@@ -134,13 +387,19 @@ def get_user(user_id):
     try:
         # Users can only access their own data unless they're admin
         if request.user_role != 'admin' and request.user_id != user_id:
-            return jsonify({"error": "Access denied"}), 403
-        
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
-            return jsonify({"error": "User not found"}), 404
+            return error_response(ERROR_ACCESS_DENIED)
+        
+        # require_auth may already hold the caller's own document; copy it,
+        # since the cached original is shared across requests
+        if user_id == request.user_id and request.user_data is not None:
+            user_data = dict(request.user_data)
+        else:
+            user_doc = db.collection('users').document(user_id).get()
+            if not user_doc.exists:
+                return error_response(ERROR_USER_NOT_FOUND)
+            
+            user_data = user_doc.to_dict()
         
-        user_data = user_doc.to_dict()
         # Remove sensitive data
         user_data.pop('passwordHash', None)
         
@@ -157,7 +416,7 @@ def update_user(user_id):
     try:
         # Users can only update their own data unless they're admin
         if request.user_role != 'admin' and request.user_id != user_id:
-            return jsonify({"error": "Access denied"}), 403
+            return error_response(ERROR_ACCESS_DENIED)
         
         data = request.get_json()
         update_data = {
@@ -165,15 +424,17 @@ def update_user(user_id):
         }
         
         # Only allow certain fields to be updated
-        allowed_fields = ['profile', 'preferences', 'medicalInfo']
-        if request.user_role == 'admin':
-            allowed_fields.extend(['role', 'isActive'])
+        allowed_fields = (ADMIN_USER_UPDATE_FIELDS if request.user_role == 'admin'
+                          else USER_UPDATE_FIELDS)
         
         for field in allowed_fields:
             if field in data:
                 update_data[field] = data[field]
         
         db.collection('users').document(user_id).update(update_data)
+        if 'role' in update_data:
+            auth.set_custom_user_claims(user_id, {'role': update_data['role']})
+        invalidate_cached_auth(user_id)
         
         return jsonify({"success": True, "message": "User updated successfully"}), 200
         
@@ -185,30 +446,87 @@ def update_user(user_id):
 # SERVICE PACKAGE ENDPOINTS
 # =============================================================================
 
+SERVICE_UPDATE_FIELDS = ('name', 'description', 'price', 'durationMinutes',
+                         'imageUrl', 'features', 'category', 'isFeatured',
+                         'displayOrder', 'isActive')
+
+CREATE_SERVICE_SCHEMA = {
+    'type': 'object',
+    'required': ['name', 'description', 'price', 'durationMinutes', 'category'],
+    'properties': {
+        'name': {'type': 'string', 'minLength': 1},
+        'description': {'type': 'string'},
+        'price': {'type': 'number', 'minimum': 0},
+        'durationMinutes': {'type': 'integer', 'minimum': 1},
+        'category': {'type': 'string'},
+        'features': {'type': 'array', 'items': {'type': 'string'}}
+    }
+}
+
+# Service packages by ID, used when booking
+SERVICE_CACHE_TTL_SECONDS = 60
+_service_cache = TTLCache(maxsize=256, ttl=SERVICE_CACHE_TTL_SECONDS)
+_service_cache_lock = threading.Lock()
+
+def get_service_package(service_id: str) -> Optional[Dict]:
+    """Return a service package, from the in-process cache when fresh"""
+    with _service_cache_lock:
+        service_data = _service_cache.get(service_id)
+    
+    if service_data is None:
+        service_doc = db.collection('servicePackages').document(service_id).get()
+        if not service_doc.exists:
+            return None
+        service_data = service_doc.to_dict()
+        with _service_cache_lock:
+            _service_cache[service_id] = service_data
+    
+    return service_data
+
+# Serialized service listings keyed by (category, featured)
+SERVICE_LIST_CACHE_TTL_SECONDS = 30
+_service_list_cache = TTLCache(maxsize=64, ttl=SERVICE_LIST_CACHE_TTL_SECONDS)
+
+def invalidate_service_caches(service_id: str = None):
+    """Drop cached service data after the catalog changes"""
+    with _service_cache_lock:
+        if service_id:
+            _service_cache.pop(service_id, None)
+        _service_list_cache.clear()
+
 @app.route('/api/services', methods=['GET'])
 def get_services():
     """Get all active service packages"""
     try:
-        query = db.collection('servicePackages').where('isActive', '==', True)
-        
-        # Filter by category if specified
         category = request.args.get('category')
-        if category:
-            query = query.where('category', '==', category)
-        
-        # Filter featured services for landing page
         featured_only = request.args.get('featured') == 'true'
-        if featured_only:
-            query = query.where('isFeatured', '==', True)
+        cache_key = (category, featured_only)
         
-        docs = query.order_by('displayOrder').stream()
-        services = []
-        for doc in docs:
-            service_data = doc.to_dict()
-            service_data['id'] = doc.id
-            services.append(service_data)
+        with _service_cache_lock:
+            body = _service_list_cache.get(cache_key)
         
-        return jsonify({"success": True, "services": services}), 200
+        if body is None:
+            query = db.collection('servicePackages').where('isActive', '==', True)
+            
+            # Filter by category if specified
+            if category:
+                query = query.where('category', '==', category)
+            
+            # Filter featured services for landing page
+            if featured_only:
+                query = query.where('isFeatured', '==', True)
+            
+            services = []
+            for doc in query.order_by('displayOrder').stream():
+                service_data = doc.to_dict()
+                service_data['id'] = doc.id
+                services.append(service_data)
+            
+            body = app.json.dumps({"success": True, "services": services})
+            with _service_cache_lock:
+                _service_list_cache[cache_key] = body
+        
+        return cacheable_response(body)
         
     except Exception as e:
         logger.error(f"Error getting services: {str(e)}")
@@ -216,9 +534,11 @@ def get_services():
 
 @app.route('/api/services', methods=['POST'])
 @require_auth(['admin'])
+@validate_json(CREATE_SERVICE_SCHEMA)
 def create_service():
     """Create a new service package"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
         service_data = {
@@ -235,11 +555,12 @@ def create_service():
             'bookingCount': 0,
             'totalRevenue': 0,
             'createdBy': request.user_id,
-            'createdAt': get_current_timestamp(),
-            'updatedAt': get_current_timestamp()
+            'createdAt': now,
+            'updatedAt': now
         }
         
         doc_ref = db.collection('servicePackages').add(service_data)
+        invalidate_service_caches()
         
         return jsonify({
             "success": True,
@@ -262,15 +583,12 @@ def update_service(service_id):
             'updatedAt': get_current_timestamp()
         }
         
-        allowed_fields = ['name', 'description', 'price', 'durationMinutes', 
-                         'imageUrl', 'features', 'category', 'isFeatured', 
-                         'displayOrder', 'isActive']
-        
-        for field in allowed_fields:
+        for field in SERVICE_UPDATE_FIELDS:
             if field in data:
                 update_data[field] = data[field]
         
         db.collection('servicePackages').document(service_id).update(update_data)
+        invalidate_service_caches(service_id)
         
         return jsonify({"success": True, "message": "Service updated successfully"}), 200
         
@@ -282,29 +600,76 @@ def update_service(service_id):
 # APPOINTMENT MANAGEMENT ENDPOINTS
 # =============================================================================
 
+CREATE_APPOINTMENT_SCHEMA = {
+    'type': 'object',
+    'required': ['clientId', 'serviceId', 'dateTime'],
+    'properties': {
+        'clientId': {'type': 'string', 'minLength': 1},
+        'serviceId': {'type': 'string', 'minLength': 1},
+        'dateTime': {'type': 'string', 'minLength': 1},
+        'discount': {
+            'type': 'object',
+            'properties': {'code': {'type': 'string'}}
+        },
+        'addons': {'type': 'array'}
+    }
+}
+
+@firestore.transactional
+def _book_appointment(transaction, appointment_ref, appointment_data, notifications,
+                      promo_ref, now) -> Optional[str]:
+    # The promo code is read before any write, as transactions require
+    if promo_ref is not None:
+        promo_doc = promo_ref.get(transaction=transaction)
+        rejection = promo_code_rejection(promo_doc.to_dict() if promo_doc.exists else None, now)
+        if rejection:
+            return rejection
+    
+    transaction.create(appointment_ref, appointment_data)
+    for notification in notifications:
+        transaction.set(db.collection('notificationQueue').document(),
+                        {**notification, 'appointmentId': appointment_ref.id})
+    if notifications:
+        transaction.set(*next_notification_due_write(notifications), merge=True)
+    if promo_ref is not None:
+        transaction.update(promo_ref, {'usageCount': firestore.Increment(1)})
+    return None
+
+def book_appointment(appointment_ref, appointment_data: Dict, notifications: List[Dict],
+                     promo_ref, now: datetime) -> Optional[str]:
+    """Atomically write an appointment, its queued notifications and its promo code use;
+    returns why the promo code was refused, or None once booked"""
+    return _book_appointment(db.transaction(), appointment_ref, appointment_data, notifications,
+                             promo_ref, now)
+
 @app.route('/api/appointments', methods=['POST'])
 @require_auth()
+@validate_json(CREATE_APPOINTMENT_SCHEMA)
 def create_appointment():
     """Create a new appointment"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
-        # Get service details
-        service_doc = db.collection('servicePackages').document(data['serviceId']).get()
-        if not service_doc.exists:
+        # Self-bookings reuse the profile when require_auth already loaded it;
+        # otherwise the client is fetched alongside the service
+        if data['clientId'] == request.user_id and request.user_data is not None:
+            service_data = get_service_package(data['serviceId'])
+            client_data = request.user_data
+        else:
+            service_future = executor.submit(get_service_package, data['serviceId'])
+            client_doc = db.collection('users').document(data['clientId']).get()
+            client_data = client_doc.to_dict() if client_doc.exists else None
+            service_data = service_future.result()
+        
+        if service_data is None:
             return jsonify({"error": "Service not found"}), 404
         
-        service_data = service_doc.to_dict()
-        
-        # Get client details
-        client_doc = db.collection('users').document(data['clientId']).get()
-        if not client_doc.exists:
+        if client_data is None:
             return jsonify({"error": "Client not found"}), 404
         
-        client_data = client_doc.to_dict()
-        
         # Parse datetime
-        appointment_datetime = parser.parse(data['dateTime'])
+        appointment_datetime = parse_iso_datetime(data['dateTime'])
         
         appointment_data = {
             'client': {
@@ -332,26 +697,37 @@ def create_appointment():
             },
             'addons': data.get('addons', []),
             'notes': [],
-            'notifications': [],
             'timeline': [{
                 'event': 'created',
-                'timestamp': get_current_timestamp(),
+                'timestamp': now,
                 'userId': request.user_id,
                 'notes': 'Appointment created'
             }],
             'referralSource': data.get('referralSource', ''),
-            'createdAt': get_current_timestamp(),
-            'updatedAt': get_current_timestamp()
+            'createdAt': now,
+            'updatedAt': now
         }
         
-        doc_ref = db.collection('appointments').add(appointment_data)
+        promo_ref = None
+        discount_code = appointment_data['payment']['discount'].get('code', '').upper()
+        if discount_code:
+            promo_doc = find_promo_code(discount_code)
+            if not promo_doc:
+                return jsonify({"error": "Invalid promo code"}), 400
+            promo_ref = promo_doc.reference
+        
+        notifications = schedule_appointment_notifications(appointment_data, client_data)
         
-        # Schedule notifications
-        schedule_appointment_notifications(doc_ref[1].id, appointment_data)
+        # The appointment, its queued notifications and the promo code use commit together
+        appointment_ref = db.collection('appointments').document()
+        rejection = book_appointment(appointment_ref, appointment_data, notifications,
+                                     promo_ref, now)
+        if rejection:
+            return jsonify({"error": rejection}), 400
         
         return jsonify({
             "success": True,
-            "appointmentId": doc_ref[1].id,
+            "appointmentId": appointment_ref.id,
             "message": "Appointment created successfully"
         }), 201
         
@@ -375,11 +751,11 @@ def get_appointments():
         end_date = request.args.get('endDate')
         
         if start_date:
-            start_dt = parser.parse(start_date)
+            start_dt = parse_iso_datetime(start_date)
             query = query.where('dateTime.date', '>=', start_dt)
         
         if end_date:
-            end_dt = parser.parse(end_date)
+            end_dt = parse_iso_datetime(end_date)
             query = query.where('dateTime.date', '<=', end_dt)
         
         # Filter by status if specified
@@ -388,13 +764,7 @@ def get_appointments():
             query = query.where('status', '==', status)
         
         docs = query.order_by('dateTime.date', direction=firestore.Query.DESCENDING).stream()
-        appointments = []
-        for doc in docs:
-            appointment_data = doc.to_dict()
-            appointment_data['id'] = doc.id
-            appointments.append(appointment_data)
-        
-        return jsonify({"success": True, "appointments": appointments}), 200
+        return stream_documents('appointments', docs, "Error getting appointments")
         
     except Exception as e:
         logger.error(f"Error getting appointments: {str(e)}")
@@ -405,6 +775,7 @@ def get_appointments():
 def update_appointment(appointment_id):
     """Update appointment details"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
         # Get current appointment
@@ -417,10 +788,10 @@ def update_appointment(appointment_id):
         # Check permissions
         if (request.user_role == 'client' and 
             appointment_data['client']['id'] != request.user_id):
-            return jsonify({"error": "Access denied"}), 403
+            return error_response(ERROR_ACCESS_DENIED)
         
         update_data = {
-            'updatedAt': get_current_timestamp()
+            'updatedAt': now
         }
         
         # Handle status changes
@@ -430,27 +801,25 @@ def update_appointment(appointment_id):
             # Add timeline entry
             timeline_entry = {
                 'event': data['status'],
-                'timestamp': get_current_timestamp(),
+                'timestamp': now,
                 'userId': request.user_id,
                 'notes': data.get('statusNote', '')
             }
             
-            current_timeline = appointment_data.get('timeline', [])
-            current_timeline.append(timeline_entry)
-            update_data['timeline'] = current_timeline
+            update_data['timeline'] = firestore.ArrayUnion([timeline_entry])
             
             # Set completion/cancellation timestamps
             if data['status'] == 'completed':
-                update_data['completedAt'] = get_current_timestamp()
+                update_data['completedAt'] = now
             elif data['status'] == 'cancelled':
-                update_data['cancelledAt'] = get_current_timestamp()
+                update_data['cancelledAt'] = now
                 update_data['cancellationReason'] = data.get('cancellationReason', '')
         
         # Handle payment updates (admin/technician only)
         if request.user_role in ['admin', 'technician'] and 'payment' in data:
-            current_payment = appointment_data.get('payment', {})
-            current_payment.update(data['payment'])
-            update_data['payment'] = current_payment
+            for field, value in data['payment'].items():
+                # Quote each key so dots or dashes can't alter the field path
+                update_data[FieldPath('payment', field).to_api_repr()] = value
         
         # Handle notes
         if 'note' in data:
@@ -459,12 +828,10 @@ def update_appointment(appointment_id):
                 'content': data['note'],
                 'isPrivate': data.get('isPrivateNote', False),
                 'createdBy': request.user_id,
-                'createdAt': get_current_timestamp()
+                'createdAt': now
             }
             
-            current_notes = appointment_data.get('notes', [])
-            current_notes.append(note_entry)
-            update_data['notes'] = current_notes
+            update_data['notes'] = firestore.ArrayUnion([note_entry])
         
         db.collection('appointments').document(appointment_id).update(update_data)
         
@@ -478,19 +845,46 @@ def update_appointment(appointment_id):
 # SITE SETTINGS ENDPOINTS
 # =============================================================================
 
+# The main settings document, shared by the public endpoint and the
+# email, SMS and payment integrations
+SITE_SETTINGS_CACHE_TTL_SECONDS = 60
+_site_settings_cache = TTLCache(maxsize=1, ttl=SITE_SETTINGS_CACHE_TTL_SECONDS)
+_site_settings_lock = threading.Lock()
+
+def get_site_settings_data() -> Optional[Dict]:
+    """Return the main site settings, cached in-process; callers must not mutate them"""
+    with _site_settings_lock:
+        settings = _site_settings_cache.get('main')
+    
+    if settings is None:
+        settings_doc = db.collection('siteSettings').document('main').get()
+        if not settings_doc.exists:
+            return None
+        settings = settings_doc.to_dict()
+        with _site_settings_lock:
+            _site_settings_cache['main'] = settings
+    
+    return settings
+
+def invalidate_site_settings():
+    """Drop cached site settings after they are written"""
+    with _site_settings_lock:
+        _site_settings_cache.clear()
+
 @app.route('/api/site-settings', methods=['GET'])
 def get_site_settings():
     """Get site settings (public endpoint for landing page)"""
     try:
-        settings_doc = db.collection('siteSettings').document('main').get()
-        if not settings_doc.exists:
+        settings = get_site_settings_data()
+        if settings is None:
             return jsonify({"error": "Site settings not found"}), 404
         
-        settings_data = settings_doc.to_dict()
+        # Copy before filtering, since the cached settings are shared
+        settings_data = dict(settings)
         
         # Remove sensitive data for public access
         if 'integrations' in settings_data:
-            integrations = settings_data['integrations']
+            integrations = settings_data['integrations'] = dict(settings_data['integrations'])
             # Only keep public keys
             if 'stripe' in integrations:
                 integrations['stripe'] = {
@@ -501,7 +895,7 @@ def get_site_settings():
                 if key in integrations:
                     del integrations[key]
         
-        return jsonify({"success": True, "settings": settings_data}), 200
+        return cacheable_response(app.json.dumps({"success": True, "settings": settings_data}))
         
     except Exception as e:
         logger.error(f"Error getting site settings: {str(e)}")
@@ -524,6 +918,7 @@ def update_site_settings():
             update_data[key] = value
         
         db.collection('siteSettings').document('main').set(update_data, merge=True)
+        invalidate_site_settings()
         
         return jsonify({"success": True, "message": "Site settings updated successfully"}), 200
         
@@ -552,17 +947,29 @@ def get_testimonials():
             testimonial_data['id'] = doc.id
             testimonials.append(testimonial_data)
         
-        return jsonify({"success": True, "testimonials": testimonials}), 200
+        return cacheable_response(app.json.dumps({"success": True, "testimonials": testimonials}))
         
     except Exception as e:
         logger.error(f"Error getting testimonials: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+CREATE_TESTIMONIAL_SCHEMA = {
+    'type': 'object',
+    'required': ['clientName', 'rating', 'reviewText'],
+    'properties': {
+        'clientName': {'type': 'string', 'minLength': 1},
+        'rating': {'type': 'integer', 'minimum': 1, 'maximum': 5},
+        'reviewText': {'type': 'string'}
+    }
+}
+
 @app.route('/api/testimonials', methods=['POST'])
 @require_auth()
+@validate_json(CREATE_TESTIMONIAL_SCHEMA)
 def create_testimonial():
     """Create a new testimonial"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
         testimonial_data = {
@@ -575,11 +982,11 @@ def create_testimonial():
             'isApproved': request.user_role == 'admin',  # Auto-approve if admin
             'displayOrder': data.get('displayOrder', 0),
             'source': 'website',
-            'createdAt': get_current_timestamp()
+            'createdAt': now
         }
         
         if request.user_role == 'admin':
-            testimonial_data['approvedAt'] = get_current_timestamp()
+            testimonial_data['approvedAt'] = now
             testimonial_data['approvedBy'] = request.user_id
         
         doc_ref = db.collection('testimonials').add(testimonial_data)
@@ -598,8 +1005,104 @@ def create_testimonial():
 # PROMO CODES ENDPOINTS
 # =============================================================================
 
+def find_promo_code(code: str):
+    """Return the promo code document snapshot, or None if it does not exist"""
+    promo_doc = db.collection('promoCodes').document(code).get()
+    if promo_doc.exists:
+        return promo_doc
+    
+    # Codes created before promo codes were keyed by their code
+    legacy_docs = db.collection('promoCodes').where('code', '==', code).limit(1).stream()
+    return next(iter(legacy_docs), None)
+
+def promo_code_rejection(promo_data: Optional[Dict], now: datetime) -> Optional[str]:
+    """Return why a promo code cannot be used at `now`, or None if it can"""
+    if not promo_data or not promo_data.get('isActive'):
+        return "Invalid promo code"
+    
+    # Check validity period
+    if promo_data['validFrom'] > now or promo_data['validUntil'] < now:
+        return "Promo code expired"
+    
+    # Check usage limit
+    if promo_data['usageCount'] >= promo_data['usageLimit']:
+        return "Promo code usage limit reached"
+    
+    return None
+
+CREATE_PROMO_CODE_SCHEMA = {
+    'type': 'object',
+    'required': ['code', 'discountType', 'discountValue', 'validFrom', 'validUntil', 'usageLimit'],
+    'properties': {
+        'code': {'type': 'string', 'pattern': '^[A-Za-z0-9_-]+$'},
+        'discountType': {'type': 'string', 'enum': ['percentage', 'fixed_amount']},
+        'discountValue': {'type': 'number', 'minimum': 0},
+        'validFrom': {'type': 'string'},
+        'validUntil': {'type': 'string'},
+        'usageLimit': {'type': 'integer', 'minimum': 0},
+        'minOrderAmount': {'type': 'number', 'minimum': 0},
+        'maxDiscountAmount': {'type': 'number', 'minimum': 0},
+        'applicableServices': {'type': 'array', 'items': {'type': 'string'}}
+    }
+}
+
+VALIDATE_PROMO_CODE_SCHEMA = {
+    'type': 'object',
+    'required': ['code'],
+    'properties': {
+        'code': {'type': 'string'},
+        'serviceIds': {'type': 'array', 'items': {'type': 'string'}},
+        'orderAmount': {'type': 'number', 'minimum': 0}
+    }
+}
+
+@app.route('/api/promo-codes', methods=['POST'])
+@require_auth(['admin'])
+@validate_json(CREATE_PROMO_CODE_SCHEMA)
+def create_promo_code():
+    """Create a new promo code"""
+    try:
+        now = get_current_timestamp()
+        data = request.get_json()
+        code = data['code'].upper()
+        
+        promo_data = {
+            'code': code,
+            'description': data.get('description', ''),
+            'discountType': data['discountType'],
+            'discountValue': data['discountValue'],
+            'validFrom': parse_iso_datetime(data['validFrom']),
+            'validUntil': parse_iso_datetime(data['validUntil']),
+            'usageCount': 0,
+            'usageLimit': data['usageLimit'],
+            'minOrderAmount': data.get('minOrderAmount', 0),
+            'applicableServices': data.get('applicableServices', []),
+            'isActive': data.get('isActive', True),
+            'createdBy': request.user_id,
+            'createdAt': now,
+            'updatedAt': now
+        }
+        if 'maxDiscountAmount' in data:
+            promo_data['maxDiscountAmount'] = data['maxDiscountAmount']
+        
+        # Codes are document IDs, so create() also enforces uniqueness
+        db.collection('promoCodes').document(code).create(promo_data)
+        
+        return jsonify({
+            "success": True,
+            "code": code,
+            "message": "Promo code created successfully"
+        }), 201
+        
+    except AlreadyExists:
+        return jsonify({"error": "Promo code already exists"}), 409
+    except Exception as e:
+        logger.error(f"Error creating promo code: {str(e)}")
+        return jsonify({"error": str(e)}), 400
+
 @app.route('/api/promo-codes/validate', methods=['POST'])
 @require_auth()
+@validate_json(VALIDATE_PROMO_CODE_SCHEMA)
 def validate_promo_code():
     """Validate a promo code"""
     try:
@@ -608,26 +1111,12 @@ def validate_promo_code():
         service_ids = data.get('serviceIds', [])
         order_amount = data.get('orderAmount', 0)
         
-        # Find promo code
-        promo_docs = db.collection('promoCodes').where('code', '==', code).where('isActive', '==', True).stream()
-        promo_doc = None
-        for doc in promo_docs:
-            promo_doc = doc
-            break
+        promo_doc = find_promo_code(code) if code else None
+        promo_data = promo_doc.to_dict() if promo_doc else None
         
-        if not promo_doc:
-            return jsonify({"success": False, "error": "Invalid promo code"}), 400
-        
-        promo_data = promo_doc.to_dict()
-        now = get_current_timestamp()
-        
-        # Check validity period
-        if promo_data['validFrom'] > now or promo_data['validUntil'] < now:
-            return jsonify({"success": False, "error": "Promo code expired"}), 400
-        
-        # Check usage limit
-        if promo_data['usageCount'] >= promo_data['usageLimit']:
-            return jsonify({"success": False, "error": "Promo code usage limit reached"}), 400
+        rejection = promo_code_rejection(promo_data, get_current_timestamp())
+        if rejection:
+            return jsonify({"success": False, "error": rejection}), 400
         
         # Check minimum order amount
         if order_amount < promo_data.get('minOrderAmount', 0):
@@ -655,7 +1144,7 @@ def validate_promo_code():
                 "amount": discount_amount,
                 "percentage": promo_data['discountValue'] if promo_data['discountType'] == 'percentage' else None,
                 "code": code,
-                "description": promo_data['description']
+                "description": promo_data.get('description', '')
             }
         }), 200
         
@@ -673,38 +1162,43 @@ def get_dashboard_analytics():
     """Get dashboard analytics data"""
     try:
         # Get date range
-        end_date = datetime.utcnow()
+        end_date = get_current_timestamp()
         start_date = end_date - timedelta(days=30)  # Last 30 days
         
-        # Get appointments in date range
+        # Appointments in date range
         appointments_query = (db.collection('appointments')
                             .where('dateTime.date', '>=', start_date)
                             .where('dateTime.date', '<=', end_date))
         
-        appointments = [doc.to_dict() for doc in appointments_query.stream()]
-        
-        # Calculate metrics
-        total_appointments = len(appointments)
-        total_revenue = sum(apt.get('payment', {}).get('totalPrice', 0) 
-                          for apt in appointments 
-                          if apt.get('payment', {}).get('status') == 'paid')
-        
-        completed_appointments = [apt for apt in appointments if apt.get('status') == 'completed']
-        cancelled_appointments = [apt for apt in appointments if apt.get('status') == 'cancelled']
-        
-        completion_rate = (len(completed_appointments) / total_appointments * 100) if total_appointments > 0 else 0
-        cancellation_rate = (len(cancelled_appointments) / total_appointments * 100) if total_appointments > 0 else 0
-        
-        # Service breakdown
-        service_stats = {}
-        for apt in appointments:
-            service_name = apt.get('service', {}).get('name', 'Unknown')
-            if service_name not in service_stats:
-                service_stats[service_name] = {'bookings': 0, 'revenue': 0}
+        # Only the fields the metrics need, in a single pass over one snapshot
+        projected_docs = appointments_query.select(
+            ['status', 'service.name', 'payment.status', 'payment.totalPrice']).stream()
+        
+        total_appointments = 0
+        completed_count = 0
+        cancelled_count = 0
+        total_revenue = 0
+        service_stats = defaultdict(lambda: [0, 0])  # name -> [bookings, revenue]
+        for doc in projected_docs:
+            apt = doc.to_dict()
+            total_appointments += 1
             
-            service_stats[service_name]['bookings'] += 1
-            if apt.get('payment', {}).get('status') == 'paid':
-                service_stats[service_name]['revenue'] += apt.get('payment', {}).get('totalPrice', 0)
+            status = apt.get('status')
+            if status == 'completed':
+                completed_count += 1
+            elif status == 'cancelled':
+                cancelled_count += 1
+            
+            stats = service_stats[apt.get('service', {}).get('name', 'Unknown')]
+            stats[0] += 1
+            payment = apt.get('payment', {})
+            if payment.get('status') == 'paid':
+                price = payment.get('totalPrice', 0)
+                total_revenue += price
+                stats[1] += price
+        
+        completion_rate = (completed_count / total_appointments * 100) if total_appointments > 0 else 0
+        cancellation_rate = (cancelled_count / total_appointments * 100) if total_appointments > 0 else 0
         
         analytics_data = {
             'totalAppointments': total_appointments,
@@ -713,8 +1207,8 @@ def get_dashboard_analytics():
             'completionRate': completion_rate,
             'cancellationRate': cancellation_rate,
             'serviceBreakdown': [
-                {'serviceName': name, **stats} 
-                for name, stats in service_stats.items()
+                {'serviceName': name, 'bookings': bookings, 'revenue': revenue}
+                for name, (bookings, revenue) in service_stats.items()
             ]
         }
         
@@ -728,41 +1222,59 @@ def get_dashboard_analytics():
 # MEDIA LIBRARY ENDPOINTS
 # =============================================================================
 
+MEDIA_UPLOAD_URL_EXPIRATION = timedelta(minutes=15)
+
+UPLOAD_MEDIA_SCHEMA = {
+    'type': 'object',
+    'required': ['filename', 'mimeType'],
+    'properties': {
+        'filename': {'type': 'string', 'minLength': 1},
+        'mimeType': {'type': 'string', 'minLength': 1},
+        'tags': {'type': 'array', 'items': {'type': 'string'}}
+    }
+}
+
 @app.route('/api/media/upload', methods=['POST'])
 @require_auth(['admin'])
+@validate_json(UPLOAD_MEDIA_SCHEMA)
 def upload_media():
-    """Upload media file to Cloud Storage"""
+    """Issue a signed URL for uploading a media file directly to Cloud Storage"""
     try:
-        if 'file' not in request.files:
-            return jsonify({"error": "No file provided"}), 400
+        now = get_current_timestamp()
+        data = request.get_json()
         
-        file = request.files['file']
-        if file.filename == '':
-            return jsonify({"error": "No file selected"}), 400
+        original_filename = data['filename']
+        safe_name = secure_filename(original_filename)
+        if not safe_name:
+            return jsonify({"error": "Invalid filename"}), 400
         
         # Generate unique filename
-        timestamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
-        filename = f"{timestamp}_{file.filename}"
-        
-        # Upload to Cloud Storage
-        blob = bucket.blob(f"media/{filename}")
-        blob.upload_from_file(file)
-        blob.make_public()
+        timestamp = now.strftime('%Y%m%d_%H%M%S')
+        filename = f"{timestamp}_{safe_name}"
+        
+        blob = get_bucket().blob(f"media/{filename}")
+        upload_url = blob.generate_signed_url(
+            version='v4',
+            expiration=MEDIA_UPLOAD_URL_EXPIRATION,
+            method='PUT',
+            content_type=data['mimeType']
+        )
         
-        # Save media info to Firestore
+        # Size and type are filled in by on_media_uploaded once the upload lands
         media_data = {
             'filename': filename,
-            'originalFilename': file.filename,
-            'filePath': f"media/{filename}",
-            'fileSize': blob.size,
-            'mimeType': blob.content_type,
-            'altText': request.form.get('altText', ''),
-            'caption': request.form.get('caption', ''),
-            'tags': request.form.getlist('tags'),
-            'usageContext': request.form.get('usageContext', ''),
+            'originalFilename': original_filename,
+            'filePath': blob.name,
+            'fileSize': None,
+            'mimeType': data['mimeType'],
+            'status': 'pending',
+            'altText': data.get('altText', ''),
+            'caption': data.get('caption', ''),
+            'tags': data.get('tags', []),
+            'usageContext': data.get('usageContext', ''),
             'usageCount': 0,
             'uploadedBy': request.user_id,
-            'createdAt': get_current_timestamp()
+            'createdAt': now
         }
         
         doc_ref = db.collection('mediaLibrary').add(media_data)
@@ -770,30 +1282,85 @@ def upload_media():
         return jsonify({
             "success": True,
             "mediaId": doc_ref[1].id,
+            "uploadUrl": upload_url,
+            "filePath": blob.name,
             "publicUrl": blob.public_url,
-            "message": "File uploaded successfully"
+            "message": "Upload URL created successfully"
         }), 201
         
     except Exception as e:
         logger.error(f"Error uploading media: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+@storage_fn.on_object_finalized()
+def on_media_uploaded(event: storage_fn.CloudEvent[storage_fn.StorageObjectData]):
+    """Publish an uploaded media file and record its size and type"""
+    try:
+        file_path = event.data.name
+        if not file_path.startswith('media/'):
+            return
+        
+        media_docs = list(db.collection('mediaLibrary')
+                          .where('filePath', '==', file_path)
+                          .limit(1).stream())
+        if not media_docs:
+            logger.warning(f"No media record for uploaded file {file_path}")
+            return
+        
+        get_bucket().blob(file_path).make_public()
+        
+        media_docs[0].reference.update({
+            'fileSize': int(event.data.size),
+            'mimeType': event.data.content_type,
+            'status': 'ready',
+            'updatedAt': get_current_timestamp()
+        })
+        
+    except Exception as e:
+        logger.error(f"Error processing uploaded media: {str(e)}")
+
 # =============================================================================
 # NOTIFICATION FUNCTIONS
 # =============================================================================
 
-def schedule_appointment_notifications(appointment_id: str, appointment_data: Dict):
-    """Schedule notification reminders for an appointment"""
+# meta/nextNotificationDue holds the earliest pending scheduledFor as epoch seconds,
+# lowered atomically by every writer so the scheduler can skip idle runs
+def next_notification_due_ref():
+    return db.collection('meta').document('nextNotificationDue')
+
+def epoch_seconds(value: datetime) -> float:
+    """Seconds since the epoch, reading naive datetimes as UTC"""
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+def next_notification_due_write(notifications: List[Dict]) -> tuple:
+    """Build the (reference, fields) write that lowers nextNotificationDue"""
+    earliest = min(epoch_seconds(n['scheduledFor']) for n in notifications)
+    return next_notification_due_ref(), {'epochSeconds': firestore.Minimum(earliest)}
+
+@firestore.transactional
+def _refresh_next_notification_due(transaction, meta_ref):
+    # Reading the indicator makes a concurrent Minimum write retry this transaction
+    meta_ref.get(transaction=transaction)
+    earliest = list(transaction.get(db.collection('notificationQueue')
+                                    .where('status', '==', 'pending')
+                                    .order_by('scheduledFor')
+                                    .limit(1)))
+    transaction.set(meta_ref, {
+        'epochSeconds': (epoch_seconds(earliest[0].get('scheduledFor')) if earliest
+                         else firestore.DELETE_FIELD)
+    }, merge=True)
+
+def refresh_next_notification_due():
+    """Recompute nextNotificationDue from the queue after a run drains it"""
+    _refresh_next_notification_due(db.transaction(), next_notification_due_ref())
+
+def schedule_appointment_notifications(appointment_data: Dict, client_data: Dict) -> List[Dict]:
+    """Build the notification schedule for an appointment from client preferences"""
     try:
-        client_id = appointment_data['client']['id']
         appointment_datetime = appointment_data['dateTime']['date']
         
-        # Get client preferences
-        client_doc = db.collection('users').document(client_id).get()
-        if not client_doc.exists:
-            return
-        
-        client_data = client_doc.to_dict()
         reminder_settings = client_data.get('preferences', {}).get('reminderSettings', {})
         hours_before = reminder_settings.get('hoursBefore', [24, 2])
         
@@ -826,31 +1393,71 @@ def schedule_appointment_notifications(appointment_id: str, appointment_data: Di
             'status': 'pending'
         })
         
-        # Update appointment with scheduled notifications
-        db.collection('appointments').document(appointment_id).update({
-            'notifications': notifications
-        })
+        return notifications
         
     except Exception as e:
         logger.error(f"Error scheduling notifications: {str(e)}")
+        return []
+
+def queue_notifications_bulk(appointments: List[Tuple[str, Dict]]) -> int:
+    """Queue notifications for many stored appointments, reading each client once"""
+    client_refs = [db.collection('users').document(client_id)
+                   for client_id in {data['client']['id'] for _, data in appointments}]
+    clients = {snapshot.id: snapshot.to_dict()
+               for snapshot in db.get_all(client_refs) if snapshot.exists}
+    
+    writes = []
+    for appointment_id, appointment_data in appointments:
+        client_data = clients.get(appointment_data['client']['id'], {})
+        for notification in schedule_appointment_notifications(appointment_data, client_data):
+            writes.append((db.collection('notificationQueue').document(),
+                           {**notification, 'appointmentId': appointment_id}))
+    
+    queued = len(writes)
+    if writes:
+        writes.append(next_notification_due_write([fields for _, fields in writes]))
+    commit_in_batches(writes)
+    return queued
+
+# Provider SDKs are imported on first use to keep them out of cold starts, and
+# clients are reused per credential so they keep their connections
+@functools.lru_cache(maxsize=4)
+def get_sendgrid_client(api_key: str):
+    from sendgrid import SendGridAPIClient
+    return SendGridAPIClient(api_key=api_key)
+
+# Twilio keeps a requests session per client; size its pool to the sender threads
+# so concurrent SMS sends reuse connections instead of discarding them
+TWILIO_TIMEOUT_SECONDS = 10
+
+@functools.lru_cache(maxsize=4)
+def get_twilio_client(account_sid: str, auth_token: Optional[str]):
+    from requests.adapters import HTTPAdapter
+    from twilio.http.http_client import TwilioHttpClient
+    from twilio.rest import Client as TwilioClient
+    
+    http_client = TwilioHttpClient(timeout=TWILIO_TIMEOUT_SECONDS)
+    http_client.session.mount('https://', HTTPAdapter(pool_maxsize=NOTIFICATION_WORKERS))
+    return TwilioClient(account_sid, auth_token, http_client=http_client)
 
 def send_email_notification(to_email: str, subject: str, content: str, template_type: str = 'general'):
     """Send email notification using SendGrid"""
+    from sendgrid.helpers.mail import Mail
+    
     try:
         # Get email settings from site settings
-        settings_doc = db.collection('siteSettings').document('main').get()
-        if not settings_doc.exists:
+        settings = get_site_settings_data()
+        if settings is None:
             logger.error("Site settings not found for email configuration")
             return False
         
-        settings = settings_doc.to_dict()
         email_config = settings.get('integrations', {}).get('email', {})
         
         if not email_config.get('apiKey'):
             logger.error("SendGrid API key not configured")
             return False
         
-        sg = SendGridAPIClient(api_key=email_config['apiKey'])
+        sg = get_sendgrid_client(email_config['apiKey'])
         
         message = Mail(
             from_email=email_config.get('fromEmail', 'noreply@example.com'),
@@ -871,19 +1478,18 @@ def send_sms_notification(to_phone: str, message: str):
     """Send SMS notification using Twilio"""
     try:
         # Get SMS settings from site settings
-        settings_doc = db.collection('siteSettings').document('main').get()
-        if not settings_doc.exists:
+        settings = get_site_settings_data()
+        if settings is None:
             logger.error("Site settings not found for SMS configuration")
             return False
         
-        settings = settings_doc.to_dict()
         sms_config = settings.get('integrations', {}).get('sms', {})
         
         if not sms_config.get('apiKey'):
             logger.error("Twilio API key not configured")
             return False
         
-        client = TwilioClient(sms_config['apiKey'], sms_config.get('authToken'))
+        client = get_twilio_client(sms_config['apiKey'], sms_config.get('authToken'))
         
         message = client.messages.create(
             body=message,
@@ -902,67 +1508,164 @@ def send_sms_notification(to_phone: str, message: str):
 # SCHEDULED FUNCTIONS
 # =============================================================================
 
-@scheduler_fn.on_schedule(schedule="every 15 minutes")
+# Provider calls are network-bound, so due notifications are sent concurrently
+NOTIFICATION_WORKERS = 16
+notification_executor = ThreadPoolExecutor(max_workers=NOTIFICATION_WORKERS)
+
+FIRESTORE_BATCH_LIMIT = 500
+
+def commit_in_batches(writes: List[tuple]):
+    """Merge (document reference, fields) writes in batches of at most 500"""
+    for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+        batch = db.batch()
+        for doc_ref, fields in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+            batch.set(doc_ref, fields, merge=True)
+        batch.commit()
+
+def commit_groups_in_batches(groups: List[List[tuple]]):
+    """Merge groups of (document reference, fields) writes in batches of at most 500,
+    never splitting a group across two batches"""
+    batch, size = db.batch(), 0
+    for group in groups:
+        if size and size + len(group) > FIRESTORE_BATCH_LIMIT:
+            batch.commit()
+            batch, size = db.batch(), 0
+        for doc_ref, fields in group:
+            batch.set(doc_ref, fields, merge=True)
+        size += len(group)
+    if size:
+        batch.commit()
+
+def dispatch_notification(notification: Dict, appointment_data: Optional[Dict]) -> bool:
+    """Send a single notification through its configured channel"""
+    try:
+        if appointment_data is None:
+            logger.error(f"Appointment {notification.get('appointmentId')} not found for notification")
+            return False
+        
+        if notification['method'] == 'email':
+            # Generate email content based on notification type
+            subject, content = generate_notification_content(
+                notification['type'], 
+                appointment_data, 
+                'email'
+            )
+            return send_email_notification(
+                appointment_data['client']['email'],
+                subject,
+                content,
+                notification['type']
+            )
+        
+        if notification['method'] == 'sms':
+            # Generate SMS content
+            _, sms_content = generate_notification_content(
+                notification['type'],
+                appointment_data,
+                'sms'
+            )
+            return send_sms_notification(
+                appointment_data['client']['phone'],
+                sms_content
+            )
+        
+        return False
+        
+    except Exception as e:
+        logger.error(f"Error dispatching notification: {str(e)}")
+        return False
+
+# Set once the != scan comes back empty; new appointments never embed notifications
+_legacy_notifications_drained = threading.Event()
+
+def migrate_embedded_notifications():
+    """Move notifications still embedded in older appointments into notificationQueue"""
+    if _legacy_notifications_drained.is_set():
+        return
+    
+    while True:
+        legacy_docs = list(db.collection('appointments')
+                           .where('notifications', '!=', [])
+                           .limit(100).stream())
+        if not legacy_docs:
+            _legacy_notifications_drained.set()
+            return
+        
+        # An appointment's queue entries and its cleared list commit together, so a
+        # failed batch never leaves entries that the next run would copy again
+        groups = []
+        for appointment_doc in legacy_docs:
+            group = [(db.collection('notificationQueue').document(),
+                      {**notification, 'appointmentId': appointment_doc.id})
+                     for notification in appointment_doc.to_dict().get('notifications', [])]
+            group.append((appointment_doc.reference, {'notifications': []}))
+            groups.append(group)
+        
+        # Lowering the indicator first is safe: an early value only costs one extra check
+        migrated = [fields for group in groups for _, fields in group[:-1]
+                    if fields.get('status') == 'pending']
+        if migrated:
+            groups.insert(0, [next_notification_due_write(migrated)])
+        commit_groups_in_batches(groups)
+
+# Stop taking new pages well before the function timeout; the next run picks up the rest
+NOTIFICATION_RUN_TIMEOUT_SECONDS = 540
+NOTIFICATION_RUN_BUDGET_SECONDS = 420
+
+@scheduler_fn.on_schedule(schedule="every 15 minutes", timeout_sec=NOTIFICATION_RUN_TIMEOUT_SECONDS)
 def process_pending_notifications(req):
     """Process pending notifications that are due to be sent"""
     try:
         current_time = get_current_timestamp()
-        
-        # Find appointments with pending notifications
-        appointments_query = db.collection('appointments').where('notifications', '!=', [])
-        appointments = appointments_query.stream()
-        
-        for appointment_doc in appointments:
-            appointment_data = appointment_doc.to_dict()
-            notifications = appointment_data.get('notifications', [])
-            updated_notifications = []
-            notifications_updated = False
+        deadline = time.monotonic() + NOTIFICATION_RUN_BUDGET_SECONDS
+        migrate_embedded_notifications()
+        
+        # Most runs have nothing due; one indicator read settles that
+        next_due = next_notification_due_ref().get()
+        if next_due.exists:
+            next_due_at = next_due.to_dict().get('epochSeconds', float('inf'))
+            if next_due_at > epoch_seconds(current_time):
+                return {"success": True}
+        
+        deferred = False
+        # Each page leaves the pending set once written, so re-querying walks the backlog
+        while True:
+            # Due notifications only, served by the (status, scheduledFor) index
+            queue_docs = list(db.collection('notificationQueue')
+                              .where('status', '==', 'pending')
+                              .where('scheduledFor', '<=', current_time)
+                              .order_by('scheduledFor')
+                              .limit(FIRESTORE_BATCH_LIMIT).stream())
+            if not queue_docs:
+                break
             
-            for notification in notifications:
-                if (notification['status'] == 'pending' and 
-                    notification['scheduledFor'] <= current_time):
-                    
-                    # Send the notification
-                    success = False
-                    
-                    if notification['method'] == 'email':
-                        # Generate email content based on notification type
-                        subject, content = generate_notification_content(
-                            notification['type'], 
-                            appointment_data, 
-                            'email'
-                        )
-                        success = send_email_notification(
-                            appointment_data['client']['email'],
-                            subject,
-                            content,
-                            notification['type']
-                        )
-                    
-                    elif notification['method'] == 'sms':
-                        # Generate SMS content
-                        _, sms_content = generate_notification_content(
-                            notification['type'],
-                            appointment_data,
-                            'sms'
-                        )
-                        success = send_sms_notification(
-                            appointment_data['client']['phone'],
-                            sms_content
-                        )
-                    
-                    # Update notification status
-                    notification['status'] = 'sent' if success else 'failed'
-                    notification['sentAt'] = current_time
-                    notifications_updated = True
-                
-                updated_notifications.append(notification)
+            due = [queue_doc.to_dict() for queue_doc in queue_docs]
             
-            # Update appointment if notifications were processed
-            if notifications_updated:
-                db.collection('appointments').document(appointment_doc.id).update({
-                    'notifications': updated_notifications
-                })
+            # Fetch each affected appointment once, in a single batched read
+            appointment_refs = [db.collection('appointments').document(appointment_id)
+                                for appointment_id in {n['appointmentId'] for n in due}]
+            appointments = {snapshot.id: snapshot.to_dict()
+                            for snapshot in db.get_all(appointment_refs) if snapshot.exists}
+            
+            results = notification_executor.map(
+                dispatch_notification, due, [appointments.get(n['appointmentId']) for n in due])
+            
+            commit_in_batches([
+                (queue_doc.reference, {'status': 'sent' if success else 'failed',
+                                       'sentAt': current_time})
+                for queue_doc, success in zip(queue_docs, results)
+            ])
+            
+            if len(queue_docs) < FIRESTORE_BATCH_LIMIT:
+                break
+            if time.monotonic() >= deadline:
+                logger.warning("Notification backlog exceeds run budget; deferring the rest")
+                deferred = True
+                break
+        
+        # A deferred run leaves the indicator in the past so the next run continues
+        if not deferred:
+            refresh_next_notification_due()
         
         logger.info("Notification processing completed")
         return {"success": True}
@@ -971,59 +1674,70 @@ def process_pending_notifications(req):
         logger.error(f"Error processing notifications: {str(e)}")
         return {"error": str(e)}
 
+# Notification templates, formatted with str.format_map; email fields are HTML-escaped
+NOTIFICATION_DATE_FORMAT = '%B %d, %Y'
+
+# Shared email shell; the per-type heading, intro and closing are filled in once at
+# import, leaving the escaped appointment fields for format_map at send time
+NOTIFICATION_EMAIL_SHELL = (
+    '<html><body>'
+    '<h2>{heading}</h2>'
+    '<p>Dear {{client_name}},</p>'
+    '<p>{intro}</p>'
+    '<ul>'
+    '<li><strong>Service:</strong> {{service_name}}</li>'
+    '<li><strong>Date:</strong> {{appointment_date}}</li>'
+    '<li><strong>Time:</strong> {{appointment_time}}</li>'
+    '</ul>'
+    '<p>{closing}</p>'
+    '<p>Best regards,<br>Your Beauty Team</p>'
+    '</body></html>'
+)
+
+CONFIRMATION_EMAIL_SUBJECT = "Appointment Confirmation - {service_name}"
+CONFIRMATION_EMAIL_TEMPLATE = NOTIFICATION_EMAIL_SHELL.format(
+    heading='Appointment Confirmed!',
+    intro='Your appointment has been confirmed for:',
+    closing='We look forward to seeing you!')
+CONFIRMATION_SMS_TEMPLATE = "Hi {client_name}! Your {service_name} appointment is confirmed for {appointment_date} at {appointment_time}. See you soon!"
+
+REMINDER_EMAIL_SUBJECT = "Reminder: Upcoming Appointment - {service_name}"
+REMINDER_EMAIL_TEMPLATE = NOTIFICATION_EMAIL_SHELL.format(
+    heading='Appointment Reminder',
+    intro='This is a friendly reminder that you have an appointment in {hours} hours:',
+    closing='Please arrive 10 minutes early. If you need to reschedule, please contact us as soon as possible.')
+REMINDER_SMS_TEMPLATE = "Reminder: Hi {client_name}, your {service_name} appointment is in {hours} hours on {appointment_date} at {appointment_time}. Please arrive 10 mins early!"
+
 def generate_notification_content(notification_type: str, appointment_data: Dict, format_type: str):
     """Generate notification content based on type and format"""
-    client_name = appointment_data['client']['name']
-    service_name = appointment_data['service']['name']
-    appointment_date = appointment_data['dateTime']['date'].strftime('%B %d, %Y')
-    appointment_time = appointment_data['dateTime']['time']
+    fields = {
+        'client_name': appointment_data['client']['name'],
+        'service_name': appointment_data['service']['name'],
+        'appointment_date': appointment_data['dateTime']['date'].strftime(NOTIFICATION_DATE_FORMAT),
+        'appointment_time': appointment_data['dateTime']['time']
+    }
+    
+    if 'reminder' in notification_type:
+        fields['hours'] = notification_type.split('_')[1].replace('h', '')
+    
+    if format_type == 'email':
+        html_fields = {key: html.escape(str(value)) for key, value in fields.items()}
     
     if notification_type == 'confirmation':
         if format_type == 'email':
-            subject = f"Appointment Confirmation - {service_name}"
-            content = f"""
-            <html>
-            <body>
-                <h2>Appointment Confirmed!</h2>
-                <p>Dear {client_name},</p>
-                <p>Your appointment has been confirmed for:</p>
-                <ul>
-                    <li><strong>Service:</strong> {service_name}</li>
-                    <li><strong>Date:</strong> {appointment_date}</li>
-                    <li><strong>Time:</strong> {appointment_time}</li>
-                </ul>
-                <p>We look forward to seeing you!</p>
-                <p>Best regards,<br>Your Beauty Team</p>
-            </body>
-            </html>
-            """
+            subject = CONFIRMATION_EMAIL_SUBJECT.format_map(fields)
+            content = CONFIRMATION_EMAIL_TEMPLATE.format_map(html_fields)
         else:  # SMS
             subject = ""
-            content = f"Hi {client_name}! Your {service_name} appointment is confirmed for {appointment_date} at {appointment_time}. See you soon!"
+            content = CONFIRMATION_SMS_TEMPLATE.format_map(fields)
     
     elif 'reminder' in notification_type:
-        hours = notification_type.split('_')[1].replace('h', '')
         if format_type == 'email':
-            subject = f"Reminder: Upcoming Appointment - {service_name}"
-            content = f"""
-            <html>
-            <body>
-                <h2>Appointment Reminder</h2>
-                <p>Dear {client_name},</p>
-                <p>This is a friendly reminder that you have an appointment in {hours} hours:</p>
-                <ul>
-                    <li><strong>Service:</strong> {service_name}</li>
-                    <li><strong>Date:</strong> {appointment_date}</li>
-                    <li><strong>Time:</strong> {appointment_time}</li>
-                </ul>
-                <p>Please arrive 10 minutes early. If you need to reschedule, please contact us as soon as possible.</p>
-                <p>Best regards,<br>Your Beauty Team</p>
-            </body>
-            </html>
-            """
+            subject = REMINDER_EMAIL_SUBJECT.format_map(fields)
+            content = REMINDER_EMAIL_TEMPLATE.format_map(html_fields)
         else:  # SMS
             subject = ""
-            content = f"Reminder: Your {service_name} appointment is in {hours} hours on {appointment_date} at {appointment_time}. Please arrive 10 mins early!"
+            content = REMINDER_SMS_TEMPLATE.format_map(fields)
     
     return subject, content
 
@@ -1035,50 +1749,53 @@ def generate_notification_content(notification_type: str, appointment_data: Dict
 def generate_daily_analytics(req):
     """Generate daily analytics data"""
     try:
-        yesterday = datetime.utcnow().date() - timedelta(days=1)
-        start_of_day = datetime.combine(yesterday, datetime.min.time())
-        end_of_day = datetime.combine(yesterday, datetime.max.time())
+        now = get_current_timestamp()
+        yesterday = now.date() - timedelta(days=1)
+        start_of_day = datetime(yesterday.year, yesterday.month, yesterday.day, tzinfo=timezone.utc)
+        end_of_day = start_of_day + timedelta(days=1)
         
-        # Get appointments for yesterday
+        # Get appointments for yesterday as a half-open range over the dateTime.date index
         appointments_query = (db.collection('appointments')
                             .where('dateTime.date', '>=', start_of_day)
-                            .where('dateTime.date', '<=', end_of_day))
-        
-        appointments = [doc.to_dict() for doc in appointments_query.stream()]
-        
-        # Calculate metrics
-        total_appointments = len(appointments)
-        completed_appointments = [apt for apt in appointments if apt.get('status') == 'completed']
-        cancelled_appointments = [apt for apt in appointments if apt.get('status') == 'cancelled']
-        
-        total_revenue = sum(apt.get('payment', {}).get('totalPrice', 0) 
-                          for apt in appointments 
-                          if apt.get('payment', {}).get('status') == 'paid')
-        
-        # Service breakdown
-        service_breakdown = {}
-        for apt in appointments:
-            service_id = apt.get('service', {}).get('id')
-            service_name = apt.get('service', {}).get('name', 'Unknown')
+                            .where('dateTime.date', '<', end_of_day)
+                            .order_by('dateTime.date'))
+        
+        # Calculate all metrics in a single pass
+        total_appointments = 0
+        completed_count = 0
+        cancelled_count = 0
+        total_revenue = 0
+        service_names = {}
+        service_stats = defaultdict(lambda: [0, 0])  # id -> [bookings, revenue]
+        payment_methods = {'stripe': 0, 'cash': 0, 'bankTransfer': 0}
+        projected_docs = appointments_query.select(
+            ['status', 'service.id', 'service.name', 'payment.method',
+             'payment.status', 'payment.totalPrice']).stream()
+        for doc in projected_docs:
+            apt = doc.to_dict()
+            total_appointments += 1
             
-            if service_id not in service_breakdown:
-                service_breakdown[service_id] = {
-                    'serviceId': service_id,
-                    'serviceName': service_name,
-                    'bookings': 0,
-                    'revenue': 0
-                }
+            status = apt.get('status')
+            if status == 'completed':
+                completed_count += 1
+            elif status == 'cancelled':
+                cancelled_count += 1
             
-            service_breakdown[service_id]['bookings'] += 1
-            if apt.get('payment', {}).get('status') == 'paid':
-                service_breakdown[service_id]['revenue'] += apt.get('payment', {}).get('totalPrice', 0)
-        
-        # Payment method breakdown
-        payment_methods = {'stripe': 0, 'cash': 0, 'bankTransfer': 0}
-        for apt in appointments:
-            payment_method = apt.get('payment', {}).get('method', 'stripe')
+            service = apt.get('service', {})
+            service_id = service.get('id')
+            service_names.setdefault(service_id, service.get('name', 'Unknown'))
+            stats = service_stats[service_id]
+            stats[0] += 1
+            
+            payment = apt.get('payment', {})
+            price = payment.get('totalPrice', 0)
+            if payment.get('status') == 'paid':
+                total_revenue += price
+                stats[1] += price
+            
+            payment_method = payment.get('method', 'stripe')
             if payment_method in payment_methods:
-                payment_methods[payment_method] += apt.get('payment', {}).get('totalPrice', 0)
+                payment_methods[payment_method] += price
         
         analytics_data = {
             'type': 'daily',
@@ -1087,13 +1804,17 @@ def generate_daily_analytics(req):
                 'totalAppointments': total_appointments,
                 'totalRevenue': total_revenue,
                 'averageBookingValue': total_revenue / total_appointments if total_appointments > 0 else 0,
-                'completionRate': (len(completed_appointments) / total_appointments * 100) if total_appointments > 0 else 0,
-                'cancellationRate': (len(cancelled_appointments) / total_appointments * 100) if total_appointments > 0 else 0,
+                'completionRate': (completed_count / total_appointments * 100) if total_appointments > 0 else 0,
+                'cancellationRate': (cancelled_count / total_appointments * 100) if total_appointments > 0 else 0,
                 'noShowRate': 0,  # Calculate based on no-show status
-                'serviceBreakdown': list(service_breakdown.values()),
+                'serviceBreakdown': [
+                    {'serviceId': service_id, 'serviceName': service_names[service_id],
+                     'bookings': bookings, 'revenue': revenue}
+                    for service_id, (bookings, revenue) in service_stats.items()
+                ],
                 'paymentMethodBreakdown': payment_methods
             },
-            'generatedAt': get_current_timestamp()
+            'generatedAt': now
         }
         
         # Save analytics data
@@ -1110,16 +1831,29 @@ def generate_daily_analytics(req):
 # PAYMENT PROCESSING ENDPOINTS
 # =============================================================================
 
+CREATE_PAYMENT_INTENT_SCHEMA = {
+    'type': 'object',
+    'required': ['appointmentId'],
+    'properties': {
+        'appointmentId': {'type': 'string', 'minLength': 1}
+    }
+}
+
 @app.route('/api/payments/create-intent', methods=['POST'])
 @require_auth()
+@validate_json(CREATE_PAYMENT_INTENT_SCHEMA)
 def create_payment_intent():
     """Create Stripe payment intent for appointment"""
+    import stripe
+    
     try:
         data = request.get_json()
-        appointment_id = data.get('appointmentId')
+        appointment_id = data['appointmentId']
         
-        # Get appointment details
+        # Read the appointment and Stripe configuration in parallel
+        settings_future = executor.submit(get_site_settings_data)
         appointment_doc = db.collection('appointments').document(appointment_id).get()
+        settings = settings_future.result()
         if not appointment_doc.exists:
             return jsonify({"error": "Appointment not found"}), 404
         
@@ -1128,18 +1862,17 @@ def create_payment_intent():
         # Check if user can pay for this appointment
         if (request.user_role == 'client' and 
             appointment_data['client']['id'] != request.user_id):
-            return jsonify({"error": "Access denied"}), 403
+            return error_response(ERROR_ACCESS_DENIED)
         
-        # Get Stripe configuration
-        settings_doc = db.collection('siteSettings').document('main').get()
-        if not settings_doc.exists:
+        if settings is None:
             return jsonify({"error": "Payment configuration not found"}), 500
         
-        stripe_config = settings_doc.to_dict().get('integrations', {}).get('stripe', {})
+        stripe_config = settings.get('integrations', {}).get('stripe', {})
         if not stripe_config.get('secretKey'):
             return jsonify({"error": "Stripe not configured"}), 500
         
-        stripe.api_key = stripe_config['secretKey']
+        if stripe.api_key != stripe_config['secretKey']:
+            stripe.api_key = stripe_config['secretKey']
         
         # Calculate total amount
         total_amount = appointment_data['payment']['totalPrice']
@@ -1173,19 +1906,23 @@ def create_payment_intent():
         logger.error(f"Error creating payment intent: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+HANDLED_STRIPE_EVENTS = frozenset({'payment_intent.succeeded', 'payment_intent.payment_failed'})
+
 @app.route('/api/payments/webhook', methods=['POST'])
 def stripe_webhook():
     """Handle Stripe webhook events"""
+    import stripe
+    
     try:
         payload = request.get_data()
         sig_header = request.headers.get('Stripe-Signature')
         
-        # Get webhook secret from settings
-        settings_doc = db.collection('siteSettings').document('main').get()
-        if not settings_doc.exists:
+        # Get webhook secret from cached settings
+        settings = get_site_settings_data()
+        if settings is None:
             return jsonify({"error": "Configuration not found"}), 500
         
-        webhook_secret = settings_doc.to_dict().get('integrations', {}).get('stripe', {}).get('webhookSecret')
+        webhook_secret = settings.get('integrations', {}).get('stripe', {}).get('webhookSecret')
         if not webhook_secret:
             return jsonify({"error": "Webhook secret not configured"}), 500
         
@@ -1197,6 +1934,12 @@ def stripe_webhook():
         except stripe.error.SignatureVerificationError:
             return jsonify({"error": "Invalid signature"}), 400
         
+        # Acknowledge events we don't act on without touching Firestore
+        if event['type'] not in HANDLED_STRIPE_EVENTS:
+            return jsonify({"success": True}), 200
+        
+        now = get_current_timestamp()
+        
         # Handle payment success
         if event['type'] == 'payment_intent.succeeded':
             payment_intent = event['data']['object']
@@ -1206,8 +1949,8 @@ def stripe_webhook():
             db.collection('appointments').document(appointment_id).update({
                 'payment.status': 'paid',
                 'payment.method': 'stripe',
-                'payment.processedAt': get_current_timestamp(),
-                'updatedAt': get_current_timestamp()
+                'payment.processedAt': now,
+                'updatedAt': now
             })
             
             logger.info(f"Payment successful for appointment {appointment_id}")
@@ -1220,7 +1963,7 @@ def stripe_webhook():
             # Update appointment payment status
             db.collection('appointments').document(appointment_id).update({
                 'payment.status': 'failed',
-                'updatedAt': get_current_timestamp()
+                'updatedAt': now
             })
             
             logger.warning(f"Payment failed for appointment {appointment_id}")
@@ -1235,33 +1978,80 @@ def stripe_webhook():
 # CONTENT MANAGEMENT ENDPOINTS
 # =============================================================================
 
+# Serialized page content keyed by slug, tagged with the contentVersions counter
+# so other instances' edits show up once the short version TTL lapses
+PAGE_CONTENT_CACHE_TTL_SECONDS = 300
+CONTENT_VERSION_CACHE_TTL_SECONDS = 15
+_page_content_cache = TTLCache(maxsize=64, ttl=PAGE_CONTENT_CACHE_TTL_SECONDS)
+_content_version_cache = TTLCache(maxsize=64, ttl=CONTENT_VERSION_CACHE_TTL_SECONDS)
+_page_content_lock = threading.Lock()
+
+def get_content_version(page_slug: str) -> int:
+    """Return the page's content version, re-read at most every few seconds"""
+    with _page_content_lock:
+        version = _content_version_cache.get(page_slug)
+    
+    if version is None:
+        version_doc = db.collection('contentVersions').document(page_slug).get()
+        version = version_doc.to_dict().get('version', 0) if version_doc.exists else 0
+        with _page_content_lock:
+            _content_version_cache[page_slug] = version
+    
+    return version
+
+def invalidate_page_content(page_slug: str):
+    """Drop this instance's cached content for a page"""
+    with _page_content_lock:
+        _page_content_cache.pop(page_slug, None)
+        _content_version_cache.pop(page_slug, None)
+
 @app.route('/api/content/<page_slug>', methods=['GET'])
 def get_page_content(page_slug):
     """Get content blocks for a specific page"""
     try:
+        version = get_content_version(page_slug)
+        with _page_content_lock:
+            cached = _page_content_cache.get(page_slug)
+        
+        if cached is not None and cached[0] == version:
+            return cacheable_response(cached[1])
+        
         query = (db.collection('contentBlocks')
                 .where('pageSlug', '==', page_slug)
                 .where('isActive', '==', True)
                 .order_by('displayOrder'))
         
-        docs = query.stream()
-        content_blocks = []
-        for doc in docs:
-            block_data = doc.to_dict()
-            block_data['id'] = doc.id
-            content_blocks.append(block_data)
+        # Only the fields the site renders; audit fields stay server-side
+        docs = query.select(['blockType', 'blockName', 'content', 'displayOrder', 'responsive']).stream()
+        content_blocks = [{'id': doc.id, **doc.to_dict()} for doc in docs]
         
-        return jsonify({"success": True, "contentBlocks": content_blocks}), 200
+        body = app.json.dumps({"success": True, "contentBlocks": content_blocks})
+        with _page_content_lock:
+            _page_content_cache[page_slug] = (version, body)
+        
+        return cacheable_response(body)
         
     except Exception as e:
         logger.error(f"Error getting page content: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+CREATE_CONTENT_BLOCK_SCHEMA = {
+    'type': 'object',
+    'required': ['blockType', 'blockName', 'content'],
+    'properties': {
+        'blockType': {'type': 'string', 'minLength': 1},
+        'blockName': {'type': 'string', 'minLength': 1},
+        'displayOrder': {'type': 'integer'}
+    }
+}
+
 @app.route('/api/content/<page_slug>/blocks', methods=['POST'])
 @require_auth(['admin'])
+@validate_json(CREATE_CONTENT_BLOCK_SCHEMA)
 def create_content_block(page_slug):
     """Create a new content block"""
     try:
+        now = get_current_timestamp()
         data = request.get_json()
         
         block_data = {
@@ -1272,16 +2062,23 @@ def create_content_block(page_slug):
             'displayOrder': data.get('displayOrder', 0),
             'isActive': True,
             'responsive': data.get('responsive', {}),
-            'createdAt': get_current_timestamp(),
-            'updatedAt': get_current_timestamp(),
+            'createdAt': now,
+            'updatedAt': now,
             'createdBy': request.user_id
         }
         
-        doc_ref = db.collection('contentBlocks').add(block_data)
+        # Write the block and bump the page's version together
+        block_ref = db.collection('contentBlocks').document()
+        batch = db.batch()
+        batch.set(block_ref, block_data)
+        batch.set(db.collection('contentVersions').document(page_slug),
+                  {'version': firestore.Increment(1)}, merge=True)
+        batch.commit()
+        invalidate_page_content(page_slug)
         
         return jsonify({
             "success": True,
-            "blockId": doc_ref[1].id,
+            "blockId": block_ref.id,
             "message": "Content block created successfully"
         }), 201
         
@@ -1293,7 +2090,8 @@ def create_content_block(page_slug):
 # MAIN CLOUD FUNCTION ENTRY POINT
 # =============================================================================
 
-@https_fn.on_request(cors=True)
+# CORS is handled by add_cors_headers; concurrent requests share one instance
+@https_fn.on_request(concurrency=80, cpu=1)
 def api(req):
     """Main API entry point for Cloud Functions v2"""
     with app.request_context(req.environ):
@@ -1320,6 +2118,7 @@ def health_check():
 def initialize_database():
     """Initialize database with default data (run once)"""
     try:
+        now = get_current_timestamp()
         # Create default site settings
         default_settings = {
             'brand': {
@@ -1353,10 +2152,12 @@ def initialize_database():
                 'secondaryColor': '#F5DEB3',
                 'accentColor': '#D2691E'
             },
-            'updatedAt': get_current_timestamp()
+            'updatedAt': now
         }
         
-        db.collection('siteSettings').document('main').set(default_settings)
+        # All defaults are written in one atomic batch
+        batch = db.batch()
+        batch.set(db.collection('siteSettings').document('main'), default_settings)
         
         # Create default service packages
         default_services = [
@@ -1372,8 +2173,8 @@ def initialize_database():
                 'isActive': True,
                 'bookingCount': 0,
                 'totalRevenue': 0,
-                'createdAt': get_current_timestamp(),
-                'updatedAt': get_current_timestamp()
+                'createdAt': now,
+                'updatedAt': now
             },
             {
                 'name': 'Volume Lashes',
@@ -1387,13 +2188,17 @@ def initialize_database():
                 'isActive': True,
                 'bookingCount': 0,
                 'totalRevenue': 0,
-                'createdAt': get_current_timestamp(),
-                'updatedAt': get_current_timestamp()
+                'createdAt': now,
+                'updatedAt': now
             }
         ]
         
         for service in default_services:
-            db.collection('servicePackages').add(service)
+            batch.set(db.collection('servicePackages').document(), service)
+        
+        batch.commit()
+        invalidate_site_settings()
+        invalidate_service_caches()
         
         return jsonify({"success": True, "message": "Database initialized successfully"}), 200
         
@@ -1408,4 +2213,8 @@ def not_found(error):
 
 @app.errorhandler(500)
 def internal_error(error):
-    return jsonify({"error": "Internal server error"}), 500
\ No newline at end of file
+    return jsonify({"error": "Internal server error"}), 500
+
+# Compile the URL map at import, once every route is registered, so the first
+# request doesn't pay for it
+app.url_map.update()
@@ -1,127 +1,25 @@
 import pytest
-import json
-from unittest.mock import Mock, patch, MagicMock
-from datetime import datetime, timedelta
-import pytz
-from flask import Flask
+import threading
+from types import MappingProxyType, SimpleNamespace
+from unittest.mock import DEFAULT, Mock, patch, MagicMock
+from datetime import datetime, timedelta, timezone
+from flask import Flask, jsonify, request
+from google.api_core.datetime_helpers import DatetimeWithNanoseconds
+from werkzeug.exceptions import BadRequest
+from google.auth.credentials import AnonymousCredentials
+from firebase_admin import firestore
 
 # Import the main module
 from main import (
-    app, db, get_current_timestamp, validate_auth_token,
+    app, db, get_current_timestamp, parse_iso_datetime, validate_auth_token,
+    FirestoreClientPool, PooledFirestoreClient, FIRESTORE_CHANNEL_OPTIONS,
     require_auth, send_email_notification, send_sms_notification,
     generate_notification_content, schedule_appointment_notifications
 )
 
-# Test configuration
-@pytest.fixture
-def client():
-    """Create a test client for the Flask app"""
-    app.config['TESTING'] = True
-    with app.test_client() as client:
-        yield client
-
-@pytest.fixture
-def mock_db():
-    """Mock Firestore database"""
-    with patch('main.db') as mock:
-        yield mock
-
-@pytest.fixture
-def mock_auth():
-    """Mock Firebase Auth"""
-    with patch('main.auth') as mock:
-        yield mock
-
-@pytest.fixture
-def mock_storage():
-    """Mock Firebase Storage"""
-    with patch('main.bucket') as mock:
-        yield mock
-
-@pytest.fixture
-def valid_auth_token():
-    """Mock valid auth token"""
-    return "valid_token_123"
-
-@pytest.fixture
-def mock_user_data():
-    """Mock user data"""
-    return {
-        'uid': 'user123',
-        'email': 'test@example.com',
-        'role': 'client',
-        'profile': {
-            'firstName': 'John',
-            'lastName': 'Doe',
-            'phone': '+1234567890'
-        },
-        'preferences': {
-            'notificationMethod': 'email',
-            'reminderSettings': {
-                'email': True,
-                'sms': False,
-                'hoursBefore': [24, 2]
-            }
-        }
-    }
-
-@pytest.fixture
-def mock_admin_user_data():
-    """Mock admin user data"""
-    return {
-        'uid': 'admin123',
-        'email': 'admin@example.com',
-        'role': 'admin',
-        'profile': {
-            'firstName': 'Admin',
-            'lastName': 'User'
-        }
-    }
-
-@pytest.fixture
-def mock_service_data():
-    """Mock service package data"""
-    return {
-        'id': 'service123',
-        'name': 'Classic Lashes',
-        'description': 'Natural-looking individual lash extensions',
-        'price': 120,
-        'durationMinutes': 120,
-        'category': 'classic',
-        'features': ['1:1 ratio', 'Natural look', 'Lasting 4-6 weeks'],
-        'isFeatured': True,
-        'displayOrder': 1,
-        'isActive': True
-    }
-
-@pytest.fixture
-def mock_appointment_data():
-    """Mock appointment data"""
-    return {
-        'id': 'appointment123',
-        'client': {
-            'id': 'user123',
-            'name': 'John Doe',
-            'email': 'test@example.com',
-            'phone': '+1234567890'
-        },
-        'service': {
-            'id': 'service123',
-            'name': 'Classic Lashes',
-            'price': 120,
-            'duration': 120
-        },
-        'dateTime': {
-            'date': datetime.utcnow() + timedelta(days=1),
-            'time': '14:00',
-            'timezone': 'UTC'
-        },
-        'status': 'confirmed',
-        'payment': {
-            'status': 'pending',
-            'totalPrice': 120
-        }
-    }
+# Request headers for the signed-in fixtures; the token value itself is never checked
+_AUTH = MappingProxyType({'Authorization': 'Bearer valid_token'})
+_ADMIN_AUTH = MappingProxyType({'Authorization': 'Bearer admin_token'})
 
 # =============================================================================
 # UTILITY FUNCTION TESTS
@@ -133,8 +31,24 @@ class TestUtilityFunctions:
         """Test current timestamp generation"""
         timestamp = get_current_timestamp()
         assert isinstance(timestamp, datetime)
+        assert timestamp.tzinfo == timezone.utc
         # Should be within 1 second of now
-        assert abs((datetime.utcnow() - timestamp).total_seconds()) < 1
+        assert abs((datetime.now(timezone.utc) - timestamp).total_seconds()) < 1
+    
+    @pytest.mark.parametrize('value, expected', [
+        ('2024-12-15T14:00:00Z', datetime(2024, 12, 15, 14, 0, tzinfo=timezone.utc)),
+        ('2024-12-15T14:00:00.250+02:00',
+         datetime(2024, 12, 15, 14, 0, 0, 250000, tzinfo=timezone(timedelta(hours=2)))),
+        ('2024-12-15', datetime(2024, 12, 15)),
+    ])
+    def test_parse_iso_datetime(self, value, expected):
+        """Test ISO 8601 parsing, including the 'Z' suffix"""
+        assert parse_iso_datetime(value) == expected
+    
+    def test_parse_iso_datetime_rejects_other_formats(self):
+        """Test non-ISO input is rejected rather than guessed at"""
+        with pytest.raises(ValueError):
+            parse_iso_datetime('December 15, 2024 2pm')
     
     @patch('main.auth.verify_id_token')
     def test_validate_auth_token_success(self, mock_verify):
@@ -157,27 +71,125 @@ class TestUtilityFunctions:
         assert result['success'] is False
         assert 'error' in result
     
-    def test_generate_notification_content_confirmation_email(self, mock_appointment_data):
-        """Test email confirmation content generation"""
-        subject, content = generate_notification_content(
-            'confirmation', mock_appointment_data, 'email'
-        )
+    @pytest.mark.parametrize('kind, channel, subject_contains, body_contains', [
+        ('confirmation', 'email', 'Appointment Confirmation', ['John Doe', 'Classic Lashes', '<html>']),
+        ('confirmation', 'sms', '', ['John Doe', 'Classic Lashes', 'confirmed']),
+        ('reminder_24h', 'email', 'Reminder', ['John Doe', 'Classic Lashes', '24 hours', '<html>']),
+        ('reminder_24h', 'sms', '', ['Reminder', 'John Doe', '24 hours']),
+    ])
+    def test_generate_notification_content(self, mock_appointment_data, kind, channel,
+                                           subject_contains, body_contains):
+        """Test each notification kind and channel renders its subject and body"""
+        subject, content = generate_notification_content(kind, mock_appointment_data, channel)
+        
+        assert subject_contains in subject
+        if channel == 'sms':
+            assert subject == ""
+        assert all(fragment in content for fragment in body_contains)
+    
+    def test_schedule_appointment_notifications(self, mock_db, mock_appointment_data,
+                                                mock_user_data):
+        """Test reminders follow client preferences without extra reads or writes"""
+        notifications = schedule_appointment_notifications(mock_appointment_data, mock_user_data)
+        
+        assert [n['type'] for n in notifications] == ['reminder_24h', 'reminder_2h', 'confirmation']
+        assert all(n['method'] == 'email' for n in notifications)
+        assert notifications[0]['scheduledFor'] == (
+            mock_appointment_data['dateTime']['date'] - timedelta(hours=24))
+        assert not mock_db.mock_calls
+
+    def test_cors_headers_on_preflight_and_response(self, client):
+        """Test preflight and regular responses carry the CORS headers"""
+        preflight = client.options('/api/appointments', headers={
+            'Origin': 'https://studio.example',
+            'Access-Control-Request-Method': 'POST',
+            'Access-Control-Request-Headers': 'Authorization, Content-Type'
+        })
+        response = client.get('/api/users/test123')
         
-        assert 'Appointment Confirmation' in subject
-        assert 'John Doe' in content
-        assert 'Classic Lashes' in content
-        assert '<html>' in content
+        assert preflight.status_code == 200
+        assert 'Authorization' in preflight.headers['Access-Control-Allow-Headers']
+        assert 'POST' in preflight.headers['Access-Control-Allow-Methods']
+        assert response.headers['Access-Control-Allow-Origin'] == '*'
+
+# =============================================================================
+# JSON PROVIDER TESTS
+# =============================================================================
+
+class TestJsonProvider:
     
-    def test_generate_notification_content_reminder_sms(self, mock_appointment_data):
-        """Test SMS reminder content generation"""
-        subject, content = generate_notification_content(
-            'reminder_24h', mock_appointment_data, 'sms'
+    def test_datetimes_serialize_as_http_dates(self):
+        """Test datetimes keep the stdlib provider's HTTP-date format"""
+        firestore_timestamp = DatetimeWithNanoseconds(2024, 12, 15, 14, 0, tzinfo=timezone.utc)
+        with app.app_context():
+            response = jsonify({'b': datetime(2024, 12, 15, 14, 0), 'a': firestore_timestamp})
+        
+        assert response.get_data(as_text=True) == (
+            '{"a":"Sun, 15 Dec 2024 14:00:00 GMT","b":"Sun, 15 Dec 2024 14:00:00 GMT"}'
         )
-        
-        assert subject == ""
-        assert 'Reminder' in content
-        assert 'John Doe' in content
-        assert '24 hours' in content
+    
+    def test_invalid_json_body_is_bad_request(self):
+        """Test malformed request bodies still raise a 400 through get_json"""
+        with app.test_request_context('/api/services', method='POST',
+                                      data='{"name": ', content_type='application/json'):
+            with pytest.raises(BadRequest) as excinfo:
+                request.get_json()
+        
+        assert excinfo.value.code == 400
+
+# =============================================================================
+# FIRESTORE CLIENT POOL TESTS
+# =============================================================================
+
+class TestFirestoreClientPool:
+    
+    def test_clients_created_lazily_and_per_thread(self):
+        """Test clients are only built on first use and pinned to their thread"""
+        pool = FirestoreClientPool(2)
+        created = []
+        
+        def create_client():
+            client = Mock(name=f'client{len(created)}')
+            created.append(client)
+            return client
+        
+        with patch.object(pool, '_create_client', side_effect=create_client):
+            assert created == []
+            
+            first = pool.client()
+            assert pool.client() is first
+            assert pool.collection is first.collection
+            
+            assigned = []
+            for _ in range(2):
+                thread = threading.Thread(target=lambda: assigned.append(pool.client()))
+                thread.start()
+                thread.join()
+        
+        # Slots are handed out round-robin and reused once every slot is filled
+        assert len(created) == 2
+        assert assigned == [created[1], created[0]]
+    
+    def test_private_attributes_do_not_create_clients(self):
+        """Test dunder probes (e.g. from mock.patch) never build a client"""
+        pool = FirestoreClientPool(1)
+        with patch.object(pool, '_create_client') as mock_create:
+            assert not hasattr(pool, '__code__')
+            mock_create.assert_not_called()
+    
+    def test_pooled_client_uses_private_channel(self, monkeypatch):
+        """Test pooled clients open channels outside gRPC's global subchannel pool"""
+        # The emulator path builds its own insecure channel; exercise the deployed one
+        monkeypatch.delenv('FIRESTORE_EMULATOR_HOST', raising=False)
+        client = PooledFirestoreClient(project='test-project',
+                                       credentials=AnonymousCredentials())
+        with patch('google.cloud.firestore_v1.services.firestore.transports.grpc.'
+                   'FirestoreGrpcTransport.create_channel') as mock_create_channel:
+            client._firestore_api
+        
+        options = mock_create_channel.call_args.kwargs['options']
+        assert options == FIRESTORE_CHANNEL_OPTIONS
+        assert ('grpc.use_local_subchannel_pool', 1) in options
 
 # =============================================================================
 # AUTHENTICATION TESTS
@@ -185,62 +197,109 @@ class TestUtilityFunctions:
 
 class TestAuthentication:
     
-    def test_require_auth_missing_header(self, client):
-        """Test authentication with missing header"""
-        response = client.get('/api/users/test123')
-        
-        assert response.status_code == 401
-        data = json.loads(response.data)
-        assert 'Missing or invalid authorization header' in data['error']
+    @pytest.mark.parametrize('request_args, headers, verified, user_data, status, error', [
+        (('GET', '/api/users/test123'), {}, None, None,
+         401, 'Missing or invalid authorization header'),
+        (('GET', '/api/users/test123'), {'Authorization': 'InvalidFormat token123'}, None, None,
+         401, 'Missing or invalid authorization header'),
+        (('GET', '/api/users/test123'), {'Authorization': 'Bearer invalid_token'},
+         {'success': False, 'error': 'Invalid token'}, None, 401, 'Invalid token'),
+        (('GET', '/api/users/test123'), _AUTH,
+         {'success': True, 'user': {'uid': 'user123'}}, None, 404, 'User not found'),
+        # A client calling an admin-only endpoint
+        (('POST', '/api/users'), _AUTH,
+         {'success': True, 'user': {'uid': 'user123'}}, {'role': 'client'},
+         403, 'Insufficient permissions'),
+    ], ids=['missing_header', 'invalid_format', 'invalid_token', 'user_not_found',
+            'insufficient_permissions'])
+    def test_require_auth_rejects(self, mock_validate, client, mock_db, firestore_doc, request_args,
+                                  headers, verified, user_data, status, error):
+        """Test each way require_auth turns a request away"""
+        mock_validate.return_value = verified
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(user_data)
+        method, path = request_args
+        
+        response = client.open(path, method=method, headers=headers, json={'email': 'test@example.com'})
+        
+        assert response.status_code == status
+        assert response.get_json()['error'] == error
     
-    def test_require_auth_invalid_format(self, client):
-        """Test authentication with invalid header format"""
-        response = client.get('/api/users/test123', 
-                            headers={'Authorization': 'InvalidFormat token123'})
-        
-        assert response.status_code == 401
+    def test_static_error_responses_match_jsonify(self, client):
+        """Test pre-serialized errors keep the jsonify wire format in fresh responses"""
+        first = client.get('/api/users/test123')
+        second = client.get('/api/users/test123')
+        
+        with app.app_context():
+            expected = jsonify({"error": "Missing or invalid authorization header"})
+        assert first.data == second.data == expected.data
+        assert first.mimetype == 'application/json'
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_require_auth_invalid_token(self, mock_db, mock_validate, client):
-        """Test authentication with invalid token"""
-        mock_validate.return_value = {'success': False, 'error': 'Invalid token'}
-        
-        response = client.get('/api/users/test123',
-                            headers={'Authorization': 'Bearer invalid_token'})
-        
-        assert response.status_code == 401
-    
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_require_auth_user_not_found(self, mock_db, mock_validate, client):
-        """Test authentication when user document doesn't exist"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        
-        mock_doc = Mock()
-        mock_doc.exists = False
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+    def test_require_auth_caches_verified_token(self, mock_db, mock_validate, client,
+                                                firestore_doc, mock_user_data):
+        """Test repeated requests with the same token skip verification"""
+        expires_at = (datetime.now(timezone.utc) + timedelta(hours=1)).timestamp()
+        mock_validate.return_value = {
+            'success': True,
+            'user': {'uid': 'user123', 'exp': expires_at}
+        }
+
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(
+            mock_user_data, 'user123')
+
+        for _ in range(2):
+            response = client.get('/api/users/user123', headers=_AUTH)
+            assert response.status_code == 200
+
+        mock_validate.assert_called_once_with('valid_token')
+
+    def test_update_user_invalidates_cached_auth(self, mock_db, mock_validate, client,
+                                                 firestore_doc, mock_user_data):
+        """Test a cached user is re-fetched after their document is updated"""
+        expires_at = (datetime.now(timezone.utc) + timedelta(hours=1)).timestamp()
+        mock_validate.return_value = {
+            'success': True,
+            'user': {'uid': 'user123', 'exp': expires_at}
+        }
+
+        user_ref = mock_db.collection.return_value.document.return_value
+        user_ref.get.return_value = firestore_doc(mock_user_data, 'user123')
+
+        client.get('/api/users/user123', headers=_AUTH)
+        response = client.put('/api/users/user123', headers=_AUTH,
+                              json={'profile': {'firstName': 'Updated'}})
+        assert response.status_code == 200
+        assert mock_validate.call_count == 1
+
+        # The update evicted the cached entry, so the next request re-verifies
+        user_ref.get.return_value = firestore_doc({**mock_user_data, 'role': 'admin'}, 'user123')
+        response = client.get('/api/users/other_user', headers=_AUTH)
+
+        assert response.status_code == 200  # fresh role grants admin access
+        assert mock_validate.call_count == 2
+        assert user_ref.update.call_count == 1
+
+    def test_client_role_claim_skips_user_lookup(self, mock_db, mock_validate, client):
+        """Test a client role claim authorizes without reading the user document"""
+        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123', 'role': 'client'}}
+        mock_db.collection.return_value.add.return_value = (None, Mock(id='testimonial123'))
         
-        response = client.get('/api/users/test123',
-                            headers={'Authorization': 'Bearer valid_token'})
+        response = client.post('/api/testimonials',
+                             headers=_AUTH,
+                             json={'clientName': 'John D.', 'rating': 5, 'reviewText': 'Lovely'})
         
-        assert response.status_code == 404
+        assert response.status_code == 201
+        mock_db.collection.return_value.document.assert_not_called()
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_require_auth_insufficient_permissions(self, mock_db, mock_validate, client):
-        """Test authentication with insufficient permissions"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = {'role': 'client'}
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+    def test_elevated_role_claim_is_confirmed(self, mock_db, mock_validate, client, firestore_doc,
+                                              mock_user_data):
+        """Test a stale admin claim is overridden by the stored role"""
+        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123', 'role': 'admin'}}
+        # Stored as a client: the user was demoted
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(
+            mock_user_data, 'user123')
         
-        # Try to access admin-only endpoint
-        response = client.post('/api/users',
-                             headers={'Authorization': 'Bearer valid_token'},
-                             json={'email': 'test@example.com'})
+        response = client.get('/api/analytics/dashboard',
+                            headers=_AUTH)
         
         assert response.status_code == 403
 
@@ -250,90 +309,67 @@ class TestAuthentication:
 
 class TestUserManagement:
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    @patch('main.auth')
-    def test_create_user_success(self, mock_auth_module, mock_db, mock_validate, client):
+    def test_create_user_success(self, mock_auth, admin_authenticated_client, request_payload):
         """Test successful user creation"""
-        # Mock admin authentication
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'admin123'}}
-        mock_admin_doc = Mock()
-        mock_admin_doc.exists = True
-        mock_admin_doc.to_dict.return_value = {'role': 'admin'}
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_admin_doc
-        
-        # Mock user creation
-        mock_user_record = Mock()
-        mock_user_record.uid = 'new_user123'
-        mock_auth_module.create_user.return_value = mock_user_record
-        
-        mock_db.collection.return_value.document.return_value.set.return_value = None
-        
-        user_data = {
-            'email': 'newuser@example.com',
-            'password': 'password123',
-            'role': 'client',
-            'profile': {
-                'firstName': 'New',
-                'lastName': 'User'
-            }
-        }
+        client, _, _ = admin_authenticated_client
+        mock_auth.create_user.return_value = Mock(uid='new_user123')
         
         response = client.post('/api/users',
-                             headers={'Authorization': 'Bearer admin_token'},
-                             json=user_data)
+                             headers=_ADMIN_AUTH,
+                             json=dict(request_payload('create_user')))
         
         assert response.status_code == 201
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['userId'] == 'new_user123'
+        mock_auth.set_custom_user_claims.assert_called_once_with(
+            'new_user123', {'role': 'client'})
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_get_user_success(self, mock_db, mock_validate, client, mock_user_data):
-        """Test successful user retrieval"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
+    @pytest.mark.parametrize('user_data', [
+        {'email': 'newuser@example.com', 'password': 'password123'},
+        {'email': 'newuser@example.com', 'password': 'short', 'profile': {'firstName': 'New', 'lastName': 'User'}},
+        {'email': 'newuser@example.com', 'password': 'password123', 'profile': {'firstName': 'New'}},
+    ])
+    def test_create_user_rejects_invalid_body(self, mock_auth, admin_authenticated_client,
+                                              user_data):
+        """Test malformed bodies fail schema validation before any side effects"""
+        client, _, _ = admin_authenticated_client
         
-        # Mock user document
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+        response = client.post('/api/users',
+                             headers=_ADMIN_AUTH,
+                             json=user_data)
+        
+        assert response.status_code == 400
+        assert response.get_json()['error'].startswith('data')
+        mock_auth.create_user.assert_not_called()
+    
+    def test_get_user_success(self, authenticated_client):
+        """Test successful user retrieval"""
+        client, mock_db, _ = authenticated_client
         
         response = client.get('/api/users/user123',
-                            headers={'Authorization': 'Bearer valid_token'})
+                            headers=_AUTH)
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['user']['email'] == 'test@example.com'
+        # The auth lookup's document is reused rather than read again
+        mock_db.collection.return_value.document.return_value.get.assert_called_once()
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_get_user_access_denied(self, mock_db, mock_validate, client, mock_user_data):
+    def test_get_user_access_denied(self, authenticated_client):
         """Test user access denial for other users"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+        client, _, _ = authenticated_client
         
         # Try to access different user's data
         response = client.get('/api/users/different_user',
-                            headers={'Authorization': 'Bearer valid_token'})
+                            headers=_AUTH)
         
         assert response.status_code == 403
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_update_user_success(self, mock_db, mock_validate, client, mock_user_data):
+    def test_update_user_success(self, authenticated_client):
         """Test successful user update"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
-        mock_db.collection.return_value.document.return_value.update.return_value = None
+        client, _, _ = authenticated_client
         
         update_data = {
             'profile': {
@@ -343,11 +379,11 @@ class TestUserManagement:
         }
         
         response = client.put('/api/users/user123',
-                            headers={'Authorization': 'Bearer valid_token'},
+                            headers=_AUTH,
                             json=update_data)
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
 
 # =============================================================================
@@ -356,70 +392,78 @@ class TestUserManagement:
 
 class TestServicePackages:
     
-    @patch('main.db')
-    def test_get_services_success(self, mock_db, client, mock_service_data):
+    @pytest.fixture
+    def service_doc(self, firestore_doc, mock_service_data):
+        """The stored snapshot of mock_service_data"""
+        return firestore_doc(mock_service_data, 'service123')
+    
+    def test_get_services_success(self, client, stored_query, service_doc):
         """Test successful service retrieval"""
-        mock_doc = Mock()
-        mock_doc.id = 'service123'
-        mock_doc.to_dict.return_value = mock_service_data
-        
-        mock_query = Mock()
-        mock_query.order_by.return_value.stream.return_value = [mock_doc]
-        mock_db.collection.return_value.where.return_value = mock_query
+        stored_query([service_doc])
         
         response = client.get('/api/services')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert len(data['services']) == 1
         assert data['services'][0]['name'] == 'Classic Lashes'
     
-    @patch('main.db')
-    def test_get_services_with_category_filter(self, mock_db, client, mock_service_data):
+    def test_get_services_with_category_filter(self, client, stored_query, service_doc):
         """Test service retrieval with category filter"""
-        mock_doc = Mock()
-        mock_doc.id = 'service123'
-        mock_doc.to_dict.return_value = mock_service_data
-        
-        mock_query = Mock()
-        mock_query.where.return_value.order_by.return_value.stream.return_value = [mock_doc]
-        mock_db.collection.return_value.where.return_value = mock_query
+        query = stored_query([service_doc])
         
         response = client.get('/api/services?category=classic')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
+        assert data['success'] is True
+        assert query.filters == [('isActive', '==', True), ('category', '==', 'classic')]
+        assert query.order == ['displayOrder']
+    
+    @pytest.mark.parametrize('names', [[], ['Classic Lashes', 'Volume Lashes', 'Mega Volume']])
+    def test_get_services_returns_valid_json(self, client, stored_query, firestore_doc,
+                                             mock_service_data, names):
+        """Test the body is valid JSON for zero and several services"""
+        docs = [firestore_doc({**mock_service_data, 'name': name}, f'service{index}')
+                for index, name in enumerate(names)]
+        
+        stored_query(docs)
+        
+        response = client.get('/api/services')
+        
+        assert response.status_code == 200
+        assert response.mimetype == 'application/json'
+        data = response.get_json()
         assert data['success'] is True
+        assert [s['name'] for s in data['services']] == names
+        assert [s['id'] for s in data['services']] == [d.id for d in docs]
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_create_service_success(self, mock_db, mock_validate, client, mock_admin_user_data):
+    def test_get_services_cached_and_conditional(self, client, stored_query, service_doc):
+        """Test listings are cached in-process and revalidate with ETags"""
+        query = stored_query([service_doc])
+        
+        response = client.get('/api/services')
+        assert response.status_code == 200
+        assert response.headers['Cache-Control'] == 'public, max-age=60, stale-while-revalidate=300'
+        etag = response.headers['ETag']
+        
+        response = client.get('/api/services', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert response.data == b''
+        assert query.streams == 1
+    
+    def test_create_service_success(self, admin_authenticated_client, request_payload):
         """Test successful service creation"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'admin123'}}
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_admin_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
-        
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = 'new_service123'
-        mock_db.collection.return_value.add.return_value = (None, mock_doc_ref)
-        
-        service_data = {
-            'name': 'Volume Lashes',
-            'description': 'Fuller, more dramatic lash extensions',
-            'price': 180,
-            'durationMinutes': 150,
-            'category': 'volume'
-        }
+        client, mock_db, _ = admin_authenticated_client
+        mock_db.collection.return_value.add.return_value = (None, SimpleNamespace(id='new_service123'))
         
         response = client.post('/api/services',
-                             headers={'Authorization': 'Bearer admin_token'},
-                             json=service_data)
+                             headers=_ADMIN_AUTH,
+                             json=dict(request_payload('create_service')))
         
         assert response.status_code == 201
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['serviceId'] == 'new_service123'
 
@@ -429,105 +473,139 @@ class TestServicePackages:
 
 class TestAppointmentManagement:
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
     @patch('main.schedule_appointment_notifications')
-    def test_create_appointment_success(self, mock_schedule, mock_db, mock_validate, 
-                                      client, mock_user_data, mock_service_data):
+    def test_create_appointment_success(self, mock_schedule, authenticated_client, stored_docs,
+                                      mock_user_data, mock_service_data, request_payload):
         """Test successful appointment creation"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_user_doc = Mock()
-        mock_user_doc.exists = True
-        mock_user_doc.to_dict.return_value = mock_user_data
-        
-        mock_service_doc = Mock()
-        mock_service_doc.exists = True
-        mock_service_doc.to_dict.return_value = mock_service_data
-        
-        mock_db.collection.return_value.document.return_value.get.side_effect = [
-            mock_user_doc,  # First call for user auth
-            mock_service_doc,  # Second call for service
-            mock_user_doc   # Third call for client
+        client, mock_db, _ = authenticated_client
+        # The client is the caller, so only the auth lookup reads users/user123
+        stored_docs({'user123': mock_user_data, 'service123': mock_service_data},
+                    new_id='appointment123')
+        confirmation_time = datetime(2024, 12, 1, 9, 0)
+        mock_schedule.return_value = [
+            {'type': 'reminder_24h', 'method': 'email', 'status': 'pending',
+             'scheduledFor': datetime(2024, 12, 14, 14, 0)},
+            {'type': 'confirmation', 'method': 'email', 'status': 'pending',
+             'scheduledFor': confirmation_time},
         ]
         
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = 'appointment123'
-        mock_db.collection.return_value.add.return_value = (None, mock_doc_ref)
-        
-        appointment_data = {
-            'clientId': 'user123',
-            'serviceId': 'service123',
-            'dateTime': '2024-12-15T14:00:00Z'
-        }
-        
         response = client.post('/api/appointments',
-                             headers={'Authorization': 'Bearer valid_token'},
-                             json=appointment_data)
+                             headers=_AUTH,
+                             json=dict(request_payload('create_appointment')))
         
         assert response.status_code == 201
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['appointmentId'] == 'appointment123'
         mock_schedule.assert_called_once()
+        
+        # The appointment and its queued notifications commit in one transaction
+        transaction = mock_db.transaction.return_value
+        transaction.create.assert_called_once()
+        *queued, next_due = [call.args[1] for call in transaction.set.call_args_list]
+        assert [n['type'] for n in queued] == ['reminder_24h', 'confirmation']
+        assert all(n['appointmentId'] == 'appointment123' for n in queued)
+        assert next_due['epochSeconds'].value == confirmation_time.replace(tzinfo=timezone.utc).timestamp()
+        transaction.update.assert_not_called()  # no promo code
+        transaction._commit.assert_called_once()
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_get_appointments_client_filter(self, mock_db, mock_validate, 
-                                          client, mock_user_data, mock_appointment_data):
+    @patch('main.schedule_appointment_notifications')
+    def test_create_appointment_reuses_cached_service(self, mock_schedule, authenticated_client,
+                                                      stored_docs, mock_user_data,
+                                                      mock_service_data, request_payload):
+        """Test repeat bookings read the service package once"""
+        client, mock_db, _ = authenticated_client
+        stored_docs({'user123': mock_user_data, 'service123': mock_service_data},
+                    new_id='appointment123')
+        mock_schedule.return_value = []
+        
+        for _ in range(2):
+            response = client.post('/api/appointments',
+                                 headers=_AUTH,
+                                 json=dict(request_payload('create_appointment')))
+            assert response.status_code == 201
+        
+        reads = [call.args[0] for call in mock_db.collection.return_value.document.call_args_list
+                 if call.args]
+        assert reads.count('service123') == 1
+        assert reads.count('user123') == 2  # auth only, once per request
+    
+    def test_get_appointments_client_filter(self, authenticated_client, stored_query, firestore_doc,
+                                          mock_appointment_data):
         """Test appointment retrieval with client filtering"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_user_doc = Mock()
-        mock_user_doc.exists = True
-        mock_user_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_user_doc
-        
-        mock_doc = Mock()
-        mock_doc.id = 'appointment123'
-        mock_doc.to_dict.return_value = mock_appointment_data
-        
-        mock_query = Mock()
-        mock_query.where.return_value.order_by.return_value.stream.return_value = [mock_doc]
-        mock_db.collection.return_value = mock_query
+        client, _, _ = authenticated_client
+        query = stored_query([firestore_doc(mock_appointment_data, 'appointment123')])
         
         response = client.get('/api/appointments',
-                            headers={'Authorization': 'Bearer valid_token'})
+                            headers=_AUTH)
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert len(data['appointments']) == 1
+        assert query.filters == [('client.id', '==', 'user123')]
+    
+    def test_get_appointments_logs_mid_stream_failure(self, mock_validate, client, stored_query,
+                                                      firestore_doc, mock_appointment_data, caplog):
+        """Test a failure after the first document is logged and aborts the body"""
+        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123', 'role': 'client'}}
+        first_doc = firestore_doc(mock_appointment_data, 'appointment123')
+        
+        def failing_stream():
+            yield first_doc
+            raise RuntimeError('stream reset')
+        
+        stored_query(failing_stream())
+        
+        response = client.get('/api/appointments',
+                            headers=_AUTH)
+        with pytest.raises(RuntimeError):
+            response.get_data()
+        
+        assert 'Error getting appointments: stream reset' in caplog.text
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_update_appointment_status(self, mock_db, mock_validate, 
-                                     client, mock_user_data, mock_appointment_data):
+    def test_update_appointment_status(self, authenticated_client, firestore_doc,
+                                     mock_user_data, mock_appointment_data, request_payload):
         """Test appointment status update"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_user_doc = Mock()
-        mock_user_doc.exists = True
-        mock_user_doc.to_dict.return_value = mock_user_data
+        client, mock_db, _ = authenticated_client
         mock_db.collection.return_value.document.return_value.get.side_effect = [
-            mock_user_doc  # Auth check
+            firestore_doc(mock_user_data),  # Auth check
+            firestore_doc(mock_appointment_data)
         ]
         
-        mock_appointment_doc = Mock()
-        mock_appointment_doc.exists = True
-        mock_appointment_doc.to_dict.return_value = mock_appointment_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_appointment_doc
-        mock_db.collection.return_value.document.return_value.update.return_value = None
+        response = client.put('/api/appointments/appointment123',
+                            headers=_AUTH,
+                            json=dict(request_payload('update_appointment')))
         
-        update_data = {
-            'status': 'completed',
-            'statusNote': 'Service completed successfully'
-        }
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data['success'] is True
+    
+    def test_update_appointment_mutates_server_side(self, admin_authenticated_client, firestore_doc,
+                                                    mock_admin_user_data, mock_appointment_data):
+        """Test timeline/notes use ArrayUnion and payment uses quoted field paths"""
+        client, mock_db, _ = admin_authenticated_client
+        appointment_ref = mock_db.collection.return_value.document.return_value
+        appointment_ref.get.side_effect = [firestore_doc(mock_admin_user_data),
+                                           firestore_doc(mock_appointment_data)]
         
         response = client.put('/api/appointments/appointment123',
-                            headers={'Authorization': 'Bearer valid_token'},
-                            json=update_data)
+                            headers=_ADMIN_AUTH,
+                            json={
+                                'status': 'completed',
+                                'payment': {'status': 'paid', 'tip-amount': 10},
+                                'note': 'Used sensitive glue'
+                            })
         
         assert response.status_code == 200
-        data = json.loads(response.data)
-        assert data['success'] is True
+        update_data = appointment_ref.update.call_args.args[0]
+        assert isinstance(update_data['timeline'], firestore.ArrayUnion)
+        assert update_data['timeline'].values[0]['event'] == 'completed'
+        assert isinstance(update_data['notes'], firestore.ArrayUnion)
+        assert update_data['notes'].values[0]['content'] == 'Used sensitive glue'
+        assert update_data['payment.status'] == 'paid'
+        assert update_data['payment.`tip-amount`'] == 10
+        assert 'payment' not in update_data
 
 # =============================================================================
 # SITE SETTINGS TESTS
@@ -535,8 +613,7 @@ class TestAppointmentManagement:
 
 class TestSiteSettings:
     
-    @patch('main.db')
-    def test_get_site_settings_success(self, mock_db, client):
+    def test_get_site_settings_success(self, mock_db, client, firestore_doc):
         """Test successful site settings retrieval"""
         settings_data = {
             'brand': {
@@ -554,32 +631,43 @@ class TestSiteSettings:
             }
         }
         
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = settings_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(
+            settings_data, 'main')
         
         response = client.get('/api/site-settings')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert 'brand' in data['settings']
         # Check that sensitive data is filtered
         assert 'secretKey' not in str(data['settings']['integrations']['stripe'])
         assert 'email' not in data['settings']['integrations']
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_update_site_settings_success(self, mock_db, mock_validate, 
-                                        client, mock_admin_user_data):
+    @patch('main.get_sendgrid_client')
+    def test_site_settings_cached_without_leaking_filtering(self, mock_sendgrid, mock_db, client,
+                                                            firestore_doc):
+        """Test one settings read serves public requests and integrations alike"""
+        settings_ref = mock_db.collection.return_value.document.return_value
+        settings_ref.get.return_value = firestore_doc({
+            'integrations': {
+                'stripe': {'publishableKey': 'pk_test_123', 'secretKey': 'sk_test_secret'},
+                'email': {'apiKey': 'secret_email_key'}
+            }
+        }, 'main')
+        
+        client.get('/api/site-settings')
+        client.get('/api/site-settings')
+        sent = send_email_notification('test@example.com', 'Subject', '<p>Hi</p>')
+        
+        # Public filtering worked on a copy, so the cached secrets are intact
+        assert sent is True
+        mock_sendgrid.assert_called_once_with('secret_email_key')
+        settings_ref.get.assert_called_once()
+    
+    def test_update_site_settings_success(self, admin_authenticated_client):
         """Test successful site settings update"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'admin123'}}
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_admin_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
-        mock_db.collection.return_value.document.return_value.set.return_value = None
+        client, _, _ = admin_authenticated_client
         
         update_data = {
             'brand': {
@@ -588,11 +676,11 @@ class TestSiteSettings:
         }
         
         response = client.put('/api/site-settings',
-                            headers={'Authorization': 'Bearer admin_token'},
+                            headers=_ADMIN_AUTH,
                             json=update_data)
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
 
 # =============================================================================
@@ -601,8 +689,7 @@ class TestSiteSettings:
 
 class TestTestimonials:
     
-    @patch('main.db')
-    def test_get_testimonials_success(self, mock_db, client):
+    def test_get_testimonials_success(self, client, stored_query, firestore_doc):
         """Test successful testimonials retrieval"""
         testimonial_data = {
             'clientName': 'Jane Smith',
@@ -612,50 +699,27 @@ class TestTestimonials:
             'isFeatured': True
         }
         
-        mock_doc = Mock()
-        mock_doc.id = 'testimonial123'
-        mock_doc.to_dict.return_value = testimonial_data
-        
-        mock_query = Mock()
-        mock_query.order_by.return_value.stream.return_value = [mock_doc]
-        mock_db.collection.return_value.where.return_value = mock_query
+        stored_query([firestore_doc(testimonial_data, 'testimonial123')])
         
         response = client.get('/api/testimonials')
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert len(data['testimonials']) == 1
         assert data['testimonials'][0]['clientName'] == 'Jane Smith'
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_create_testimonial_success(self, mock_db, mock_validate, 
-                                      client, mock_user_data):
+    def test_create_testimonial_success(self, authenticated_client, request_payload):
         """Test successful testimonial creation"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_doc = Mock()
-        mock_doc.exists = True
-        mock_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_doc
-        
-        mock_doc_ref = Mock()
-        mock_doc_ref.id = 'testimonial123'
-        mock_db.collection.return_value.add.return_value = (None, mock_doc_ref)
-        
-        testimonial_data = {
-            'clientName': 'John Doe',
-            'rating': 5,
-            'reviewText': 'Excellent service!',
-            'serviceReceived': 'Classic Lashes'
-        }
+        client, mock_db, _ = authenticated_client
+        mock_db.collection.return_value.add.return_value = (None, SimpleNamespace(id='testimonial123'))
         
         response = client.post('/api/testimonials',
-                             headers={'Authorization': 'Bearer valid_token'},
-                             json=testimonial_data)
+                             headers=_AUTH,
+                             json=dict(request_payload('create_testimonial')))
         
         assert response.status_code == 201
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['testimonialId'] == 'testimonial123'
 
@@ -663,89 +727,540 @@ class TestTestimonials:
 # PROMO CODES TESTS
 # =============================================================================
 
+# A valid promo code around a fixed clock; TestPromoCodes freezes main's clock to _NOW
+_NOW = datetime(2024, 1, 1, tzinfo=timezone.utc)
+_BASE_PROMO = {
+    'code': 'SAVE20',
+    'description': '20% off your first set',
+    'discountType': 'percentage',
+    'discountValue': 20,
+    'usageCount': 0,
+    'usageLimit': 100,
+    'minOrderAmount': 50,
+    'isActive': True,
+    'validFrom': _NOW - timedelta(days=1),
+    'validUntil': _NOW + timedelta(days=30)
+}
+
 class TestPromoCodes:
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_validate_promo_code_success(self, mock_db, mock_validate, 
-                                       client, mock_user_data):
+    @pytest.fixture(autouse=True)
+    def _frozen_clock(self):
+        """Freeze main's clock to _NOW for every promo code test"""
+        with patch('main.get_current_timestamp', return_value=_NOW):
+            yield
+    
+    def test_validate_promo_code_success(self, authenticated_client, stored_docs, mock_user_data):
         """Test successful promo code validation"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_user_doc = Mock()
-        mock_user_doc.exists = True
-        mock_user_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_user_doc
-        
-        promo_data = {
-            'code': 'SAVE20',
-            'discountType': 'percentage',
-            'discountValue': 20,
-            'validFrom': datetime.utcnow() - timedelta(days=1),
-            'validUntil': datetime.utcnow() + timedelta(days=30),
-            'usageCount': 0,
-            'usageLimit': 100,
-            'minOrderAmount': 50,
-            'isActive': True
-        }
-        
-        mock_promo_doc = Mock()
-        mock_promo_doc.to_dict.return_value = promo_data
-        mock_db.collection.return_value.where.return_value.where.return_value.stream.return_value = [mock_promo_doc]
+        client, mock_db, _ = authenticated_client
+        stored_docs({'user123': mock_user_data, 'SAVE20': _BASE_PROMO})
         
         request_data = {
-            'code': 'SAVE20',
+            'code': 'save20',
             'serviceIds': ['service123'],
             'orderAmount': 100
         }
         
         response = client.post('/api/promo-codes/validate',
-                             headers={'Authorization': 'Bearer valid_token'},
+                             headers=_AUTH,
                              json=request_data)
         
         assert response.status_code == 200
-        data = json.loads(response.data)
+        data = response.get_json()
         assert data['success'] is True
         assert data['discount']['amount'] == 20  # 20% of 100
         assert data['discount']['code'] == 'SAVE20'
+        assert data['discount']['description'] == '20% off your first set'
+        mock_db.collection.return_value.where.assert_not_called()
+    
+    @pytest.mark.parametrize('promo_override, order_amount, expected_status, error_contains', [
+        ({'validUntil': _NOW - timedelta(days=1)}, 100, 400, 'expired'),
+        ({'validFrom': _NOW + timedelta(days=1)}, 100, 400, 'expired'),
+        ({'usageCount': 100, 'usageLimit': 100}, 100, 400, 'usage'),
+        ({'minOrderAmount': 200}, 100, 400, 'minimum'),
+        ({'isActive': False}, 100, 400, 'invalid'),
+        ({'discountType': 'fixed_amount', 'discountValue': 15}, 100, 200, None),
+        ({}, 100, 200, None),
+    ])
+    def test_validate_promo_code_rules(self, promo_override, order_amount,
+                                       expected_status, error_contains, authenticated_client,
+                                       stored_docs, mock_user_data):
+        """Test each promo code validity rule against an otherwise valid code"""
+        client, _, _ = authenticated_client
+        stored_docs({'user123': mock_user_data, 'SAVE20': {**_BASE_PROMO, **promo_override}})
+        
+        response = client.post('/api/promo-codes/validate',
+                             headers=_AUTH,
+                             json={'code': 'SAVE20', 'orderAmount': order_amount})
+        
+        assert response.status_code == expected_status
+        data = response.get_json()
+        assert data['success'] is (expected_status == 200)
+        if error_contains:
+            assert error_contains in data['error'].lower()
     
-    @patch('main.validate_auth_token')
-    @patch('main.db')
-    def test_validate_promo_code_expired(self, mock_db, mock_validate, 
-                                       client, mock_user_data):
-        """Test expired promo code validation"""
-        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123'}}
-        mock_user_doc = Mock()
-        mock_user_doc.exists = True
-        mock_user_doc.to_dict.return_value = mock_user_data
-        mock_db.collection.return_value.document.return_value.get.return_value = mock_user_doc
-        
-        promo_data = {
-            'code': 'EXPIRED',
-            'validFrom': datetime.utcnow() - timedelta(days=30),
-            'validUntil': datetime.utcnow() - timedelta(days=1),  # Expired
-            'usageCount': 0,
-            'usageLimit': 100,
-            'isActive': True
+    def test_validate_legacy_promo_code(self, authenticated_client, stored_docs, stored_query,
+                                        firestore_doc, mock_user_data):
+        """Test legacy promo codes with auto-generated IDs are found by query"""
+        client, _, _ = authenticated_client
+        stored_docs({'user123': mock_user_data})  # no SAVE20 document
+        query = stored_query([firestore_doc(_BASE_PROMO, 'legacy123')])
+        
+        response = client.post('/api/promo-codes/validate',
+                             headers=_AUTH,
+                             json={'code': 'SAVE20', 'orderAmount': 100})
+        
+        assert response.status_code == 200
+        assert response.get_json()['discount']['amount'] == 20
+        assert query.filters == [('code', '==', 'SAVE20')]
+        assert query.limits == [1]
+    
+    def test_create_promo_code_keyed_by_code(self, admin_authenticated_client):
+        """Test promo codes are stored under their uppercased code"""
+        client, mock_db, _ = admin_authenticated_client
+        
+        response = client.post('/api/promo-codes',
+                             headers=_AUTH,
+                             json={'code': 'summer10', 'discountType': 'percentage',
+                                   'discountValue': 10, 'usageLimit': 50,
+                                   'validFrom': '2024-06-01T00:00:00Z',
+                                   'validUntil': '2024-08-31T23:59:59Z'})
+        
+        assert response.status_code == 201
+        mock_db.collection.return_value.document.assert_called_with('SUMMER10')
+        promo_data = mock_db.collection.return_value.document.return_value.create.call_args.args[0]
+        assert promo_data['code'] == 'SUMMER10'
+        assert promo_data['usageCount'] == 0
+    
+    @pytest.mark.parametrize('promo_override, expected_status', [
+        ({}, 201),
+        ({'usageCount': 100, 'usageLimit': 100}, 400),
+        ({'validUntil': _NOW - timedelta(days=1)}, 400),
+    ], ids=['valid', 'exhausted', 'expired'])
+    def test_create_appointment_redeems_promo_atomically(self, promo_override, expected_status,
+                                                         authenticated_client, stored_docs,
+                                                         mock_user_data, mock_service_data,
+                                                         request_payload):
+        """Test the promo code use is counted in the booking transaction, and only if usable"""
+        client, mock_db, _ = authenticated_client
+        stored_docs({'user123': mock_user_data, 'service123': mock_service_data,
+                     'SAVE20': {**_BASE_PROMO, **promo_override}})
+        
+        response = client.post('/api/appointments',
+                             headers=_AUTH,
+                             json={**request_payload('create_appointment'),
+                                   'discount': {'code': 'SAVE20', 'amount': 20}})
+        
+        assert response.status_code == expected_status
+        transaction = mock_db.transaction.return_value
+        if expected_status == 201:
+            transaction.create.assert_called_once()
+            assert transaction.update.call_args.args[1]['usageCount'].value == 1
+        else:
+            transaction.create.assert_not_called()
+            transaction.update.assert_not_called()
+
+# =============================================================================
+# ANALYTICS TESTS
+# =============================================================================
+class TestAnalytics:
+    
+    def test_dashboard_analytics_single_pass(self, admin_authenticated_client, firestore_doc):
+        """Test dashboard metrics and breakdown come from one projected stream"""
+        client, mock_db, _ = admin_authenticated_client
+        
+        appointments = [
+            {'status': 'completed', 'service': {'name': 'Classic Lashes'},
+             'payment': {'status': 'paid', 'totalPrice': 120}},
+            {'status': 'completed', 'service': {'name': 'Volume Lashes'},
+             'payment': {'status': 'paid', 'totalPrice': 180}},
+            {'status': 'cancelled', 'service': {'name': 'Classic Lashes'},
+             'payment': {'status': 'pending', 'totalPrice': 120}},
+            {'status': 'confirmed', 'service': {'name': 'Classic Lashes'},
+             'payment': {'status': 'pending', 'totalPrice': 120}},
+        ]
+        docs = [firestore_doc(apt, f'appointment{index}') for index, apt in enumerate(appointments)]
+        window_query = mock_db.collection.return_value.where.return_value.where.return_value
+        window_query.select.return_value.stream.return_value = docs
+        
+        response = client.get('/api/analytics/dashboard',
+                            headers=_ADMIN_AUTH)
+        
+        assert response.status_code == 200
+        analytics = response.get_json()['analytics']
+        assert analytics['totalAppointments'] == 4
+        assert analytics['totalRevenue'] == 300
+        assert analytics['averageBookingValue'] == 75
+        assert analytics['completionRate'] == 50
+        assert analytics['cancellationRate'] == 25
+        breakdown = {s['serviceName']: s for s in analytics['serviceBreakdown']}
+        assert breakdown['Classic Lashes'] == {
+            'serviceName': 'Classic Lashes', 'bookings': 3, 'revenue': 120
         }
+        assert breakdown['Volume Lashes']['revenue'] == 180
+        assert sum(s['bookings'] for s in breakdown.values()) == analytics['totalAppointments']
         
-        mock_promo_doc = Mock()
-        mock_promo_doc.to_dict.return_value = promo_data
-        mock_db.collection.return_value.where.return_value.where.return_value.stream.return_value = [mock_promo_doc]
+        fields = window_query.select.call_args.args[0]
+        assert 'status' in fields
+        window_query.select.return_value.stream.assert_called_once()
+    
+    def test_generate_daily_analytics(self, mock_db, firestore_doc):
+        """Test the daily rollup's metrics, breakdowns and stored document"""
+        from main import generate_daily_analytics
+        appointments = [
+            {'status': 'completed', 'service': {'id': 'service123', 'name': 'Classic Lashes'},
+             'payment': {'status': 'paid', 'totalPrice': 120, 'method': 'stripe'}},
+            {'status': 'completed', 'service': {'id': 'service456', 'name': 'Volume Lashes'},
+             'payment': {'status': 'paid', 'totalPrice': 180, 'method': 'cash'}},
+            {'status': 'cancelled', 'service': {'id': 'service123', 'name': 'Classic Lashes'},
+             'payment': {'status': 'pending', 'totalPrice': 120}},
+        ]
+        docs = [firestore_doc(apt, f'appointment{index}') for index, apt in enumerate(appointments)]
+        window_query = mock_db.collection.return_value.where.return_value.where.return_value.order_by.return_value
+        window_query.select.return_value.stream.return_value = docs
+        
+        assert generate_daily_analytics.__wrapped__(None) == {"success": True}
+        
+        metrics = mock_db.collection.return_value.add.call_args.args[0]['metrics']
+        assert metrics['totalAppointments'] == 3
+        assert metrics['totalRevenue'] == 300
+        assert metrics['completionRate'] == pytest.approx(200 / 3)
+        assert metrics['serviceBreakdown'] == [
+            {'serviceId': 'service123', 'serviceName': 'Classic Lashes', 'bookings': 2, 'revenue': 120},
+            {'serviceId': 'service456', 'serviceName': 'Volume Lashes', 'bookings': 1, 'revenue': 180},
+        ]
+        assert metrics['paymentMethodBreakdown'] == {'stripe': 240, 'cash': 180, 'bankTransfer': 0}
+        assert 'payment.method' in window_query.select.call_args.args[0]
+        
+        where_calls = mock_db.collection.return_value.where.call_args_list
+        start = where_calls[0].args[2]
+        end = mock_db.collection.return_value.where.return_value.where.call_args.args
+        assert start.tzinfo == timezone.utc
+        assert end[1:] == ('<', start + timedelta(days=1))
+
+# =============================================================================
+# MEDIA LIBRARY TESTS
+# =============================================================================
+
+class TestMediaLibrary:
+    """Test signed-URL media uploads"""
+    
+    def test_upload_media_returns_signed_url(self, admin_authenticated_client, mock_storage):
+        """Test upload issues a signed PUT URL and records a pending file"""
+        client, mock_db, _ = admin_authenticated_client
+        mock_db.collection.return_value.add.return_value = (None, SimpleNamespace(id='media123'))
         
-        request_data = {
-            'code': 'EXPIRED',
-            'orderAmount': 100
+        blob = mock_storage.blob.return_value
+        blob.name = 'media/20241215_140000_lash_set.jpg'
+        blob.generate_signed_url.return_value = 'https://storage.example/signed'
+        blob.public_url = 'https://storage.example/public'
+        
+        response = client.post('/api/media/upload',
+                             headers=_ADMIN_AUTH,
+                             json={'filename': '../lash set.jpg', 'mimeType': 'image/jpeg'})
+        
+        assert response.status_code == 201
+        data = response.get_json()
+        assert data['uploadUrl'] == 'https://storage.example/signed'
+        assert data['mediaId'] == 'media123'
+        assert mock_storage.blob.call_args.args[0].endswith('_lash_set.jpg')
+        assert blob.generate_signed_url.call_args.kwargs['method'] == 'PUT'
+        assert blob.generate_signed_url.call_args.kwargs['content_type'] == 'image/jpeg'
+        blob.upload_from_file.assert_not_called()
+        
+        media_data = mock_db.collection.return_value.add.call_args.args[0]
+        assert media_data['status'] == 'pending'
+        assert media_data['filePath'] == blob.name
+    
+    def test_media_uploaded_trigger_marks_ready(self, mock_db, mock_storage):
+        """Test the finalize trigger publishes the file and records its size"""
+        from main import on_media_uploaded
+        media_doc = Mock()
+        query = mock_db.collection.return_value.where.return_value.limit.return_value
+        query.stream.return_value = [media_doc]
+        event = SimpleNamespace(data=SimpleNamespace(
+            name='media/20241215_140000_lash_set.jpg', size='2048',
+            content_type='image/jpeg'))
+        
+        on_media_uploaded.__wrapped__(event)
+        
+        mock_db.collection.return_value.where.assert_called_once_with(
+            'filePath', '==', 'media/20241215_140000_lash_set.jpg')
+        mock_storage.blob.return_value.make_public.assert_called_once()
+        update = media_doc.reference.update.call_args.args[0]
+        assert update['fileSize'] == 2048
+        assert update['status'] == 'ready'
+
+# =============================================================================
+# PAYMENT TESTS
+# =============================================================================
+
+STRIPE_SETTINGS = {'integrations': {'stripe': {'webhookSecret': 'whsec_test'}}}
+
+class TestPayments:
+    """Test Stripe payment intents and webhook handling"""
+    
+    @pytest.fixture(autouse=True)
+    def _patches(self):
+        """Stripe's API resources and the site settings read, shared by every payment test"""
+        with patch.multiple('stripe', PaymentIntent=DEFAULT, Webhook=DEFAULT) as stripe_mocks, \
+                patch('main.get_site_settings_data', return_value=STRIPE_SETTINGS) as mock_settings:
+            self.stripe = stripe_mocks
+            self.settings = mock_settings
+            yield
+    
+    def test_create_payment_intent(self, mock_db, mock_validate, client, firestore_doc,
+                                   mock_appointment_data):
+        """Test an intent is created for the client's own appointment"""
+        mock_validate.return_value = {'success': True, 'user': {'uid': 'user123', 'role': 'client'}}
+        self.settings.return_value = {'integrations': {'stripe': {'secretKey': 'sk_test'}}}
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(
+            mock_appointment_data, 'appointment123')
+        mock_create = self.stripe['PaymentIntent'].create
+        mock_create.return_value = Mock(id='pi_123', client_secret='pi_123_secret')
+        
+        response = client.post('/api/payments/create-intent',
+                             headers=_AUTH,
+                             json={'appointmentId': 'appointment123'})
+        
+        assert response.status_code == 200
+        self.settings.assert_called_once()
+        assert mock_create.call_args.kwargs['amount'] == 12000
+        update = mock_db.collection.return_value.document.return_value.update.call_args.args[0]
+        assert update['payment.stripePaymentIntentId'] == 'pi_123'
+    
+    def test_stripe_webhook_ignores_unhandled_events(self, mock_db, client):
+        """Test unhandled events are acknowledged without Firestore access"""
+        mock_construct = self.stripe['Webhook'].construct_event
+        mock_construct.return_value = {'type': 'customer.created', 'data': {'object': {}}}
+        
+        response = client.post('/api/payments/webhook', data=b'{}',
+                             headers={'Stripe-Signature': 'sig'})
+        
+        assert response.status_code == 200
+        mock_construct.assert_called_once_with(b'{}', 'sig', 'whsec_test')
+        mock_db.collection.assert_not_called()
+    
+    def test_stripe_webhook_marks_appointment_paid(self, mock_db, client):
+        """Test a succeeded payment intent updates its appointment"""
+        self.stripe['Webhook'].construct_event.return_value = {
+            'type': 'payment_intent.succeeded',
+            'data': {'object': {'metadata': {'appointment_id': 'appointment123'}}}
         }
         
-        response = client.post('/api/promo-codes/validate',
-                             headers={'Authorization': 'Bearer valid_token'},
-                             json=request_data)
+        response = client.post('/api/payments/webhook', data=b'{}',
+                             headers={'Stripe-Signature': 'sig'})
         
-        assert response.status_code == 400
-        data = json.loads(response.data)
-        assert data['success'] is False
-        assert 'expired' in data['error'].lower()
+        assert response.status_code == 200
+        mock_db.collection.return_value.document.assert_called_once_with('appointment123')
+        update = mock_db.collection.return_value.document.return_value.update.call_args.args[0]
+        assert update['payment.status'] == 'paid'
 
 # =============================================================================
-# ANALYTICS TESTS
-# =============================================================================
\ No newline at end of file
+# NOTIFICATION TESTS
+# =============================================================================
+
+class TestNotifications:
+    
+    @patch('main.refresh_next_notification_due')
+    @patch('main.send_email_notification', return_value=True)
+    def test_process_pending_notifications_sends_due_queue(self, mock_send_email, mock_refresh,
+                                                           mock_db, firestore_doc,
+                                                           mock_appointment_data):
+        """Test due queue entries are sent with one appointment read and one batch"""
+        from main import process_pending_notifications
+        queue = mock_db.collection.return_value
+        queue.document.return_value.get.return_value = firestore_doc(None)
+        # No appointments still embed notifications
+        queue.where.return_value.limit.return_value.stream.return_value = []
+        
+        queue_docs = [
+            firestore_doc({'type': notification_type, 'method': 'email', 'status': 'pending',
+                           'appointmentId': 'appointment123'}, f'queue{index}')
+            for index, notification_type in enumerate(('reminder_24h', 'confirmation'))
+        ]
+        due_query = queue.where.return_value.where.return_value.order_by.return_value
+        due_query.limit.return_value.stream.return_value = queue_docs
+        mock_db.get_all.return_value = [firestore_doc(mock_appointment_data, 'appointment123')]
+        
+        assert process_pending_notifications.__wrapped__(None) == {"success": True}
+        
+        queue.where.assert_any_call('status', '==', 'pending')
+        mock_db.get_all.assert_called_once()
+        assert mock_send_email.call_count == 2
+        batch = mock_db.batch.return_value
+        updates = [call.args for call in batch.set.call_args_list]
+        assert [ref for ref, _ in updates] == [doc.reference for doc in queue_docs]
+        assert all(fields['status'] == 'sent' for _, fields in updates)
+        batch.commit.assert_called_once()
+        mock_refresh.assert_called_once()
+    
+    def test_process_pending_notifications_skips_when_nothing_due(self, mock_db, firestore_doc):
+        """Test a future nextNotificationDue ends the run after one read"""
+        from main import process_pending_notifications
+        import main
+        main._legacy_notifications_drained.set()
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc({
+            'epochSeconds': (datetime.now(timezone.utc) + timedelta(hours=1)).timestamp()
+        }, 'nextNotificationDue')
+        
+        assert process_pending_notifications.__wrapped__(None) == {"success": True}
+        
+        mock_db.collection.return_value.where.assert_not_called()
+        mock_db.batch.assert_not_called()
+    
+    def test_queue_notifications_bulk_reads_each_client_once(self, mock_db, firestore_doc,
+                                                             mock_appointment_data, mock_user_data):
+        """Test bulk scheduling does one client read and chunked queue writes"""
+        from main import queue_notifications_bulk
+        mock_db.get_all.return_value = [firestore_doc(mock_user_data, 'user123')]
+        appointments = [(f'appointment{i}', mock_appointment_data) for i in range(3)]
+        
+        queued = queue_notifications_bulk(appointments)
+        
+        mock_db.get_all.assert_called_once()
+        assert len(mock_db.get_all.call_args.args[0]) == 1
+        batch = mock_db.batch.return_value
+        *queue_writes, next_due = [call.args[1] for call in batch.set.call_args_list]
+        assert len(queue_writes) == queued
+        assert {fields['appointmentId'] for fields in queue_writes} == {
+            'appointment0', 'appointment1', 'appointment2'}
+        assert 'epochSeconds' in next_due
+        batch.commit.assert_called_once()
+    
+    @patch('main.NOTIFICATION_RUN_BUDGET_SECONDS', 0)
+    @patch('main.FIRESTORE_BATCH_LIMIT', 1)
+    @patch('main.refresh_next_notification_due')
+    @patch('main.dispatch_notification', return_value=True)
+    def test_process_pending_notifications_stops_at_run_budget(self, mock_dispatch, mock_refresh,
+                                                               mock_db, firestore_doc):
+        """Test a backlog larger than the run budget is left for the next run"""
+        from main import process_pending_notifications
+        queue = mock_db.collection.return_value
+        queue.document.return_value.get.return_value = firestore_doc(None)
+        queue.where.return_value.limit.return_value.stream.return_value = []
+        due_query = queue.where.return_value.where.return_value.order_by.return_value
+        due_query.limit.return_value.stream.return_value = [
+            firestore_doc({'appointmentId': 'appointment123'}, 'queue0')
+        ]
+        
+        assert process_pending_notifications.__wrapped__(None) == {"success": True}
+        
+        due_query.limit.return_value.stream.assert_called_once()
+        mock_db.batch.return_value.commit.assert_called_once()
+        mock_refresh.assert_not_called()
+    
+    def test_twilio_client_pools_connections_per_sender_thread(self):
+        """Test the shared Twilio client's HTTPS pool fits every sender thread"""
+        from main import get_twilio_client, NOTIFICATION_WORKERS
+        get_twilio_client.cache_clear()
+        
+        twilio_client = get_twilio_client('AC123', 'token')
+        
+        assert get_twilio_client('AC123', 'token') is twilio_client
+        adapter = twilio_client.http_client.session.get_adapter('https://api.twilio.com')
+        assert adapter._pool_maxsize == NOTIFICATION_WORKERS
+        get_twilio_client.cache_clear()
+    
+    @patch('main.FIRESTORE_BATCH_LIMIT', 4)
+    def test_embedded_notifications_migrate_to_queue(self, mock_db, firestore_doc):
+        """Test notifications stored on older appointments move to the queue, each
+        appointment's entries committing in the same batch as its cleared list"""
+        from main import migrate_embedded_notifications
+        scheduled_for = datetime(2024, 12, 14, 14, 0)
+        notification = {'type': 'reminder_24h', 'method': 'email', 'status': 'pending',
+                        'scheduledFor': scheduled_for}
+        legacy_docs = [firestore_doc({'notifications': [notification]}, f'appointment{index}')
+                       for index in range(2)]
+        mock_db.collection.return_value.where.return_value.limit.return_value.stream.side_effect = [
+            legacy_docs, []
+        ]
+        batches = []
+        mock_db.batch.side_effect = lambda: batches.append(Mock()) or batches[-1]
+        
+        migrate_embedded_notifications()
+        
+        writes = [[call.args for call in batch.set.call_args_list] for batch in batches]
+        assert [len(batch_writes) for batch_writes in writes] == [3, 2]
+        assert 'epochSeconds' in writes[0][0][1]  # migrated entries lower nextNotificationDue
+        assert writes[0][1][1] == {**notification, 'appointmentId': 'appointment0'}
+        assert writes[0][2] == (legacy_docs[0].reference, {'notifications': []})
+        assert writes[1][0][1] == {**notification, 'appointmentId': 'appointment1'}
+        assert writes[1][1] == (legacy_docs[1].reference, {'notifications': []})
+        assert all(batch.commit.call_count == 1 for batch in batches)
+        
+        # Once drained, later runs skip the legacy scan entirely
+        migrate_embedded_notifications()
+        assert mock_db.collection.return_value.where.call_count == 2
+
+# =============================================================================
+# CONTENT MANAGEMENT TESTS
+# =============================================================================
+
+class TestContentManagement:
+    
+    def test_get_page_content_projects_rendered_fields(self, mock_db, client, firestore_doc):
+        """Test page content is read as a projection ordered by displayOrder"""
+        block_doc = firestore_doc({'blockType': 'hero', 'blockName': 'Welcome',
+                                   'content': {'title': 'Lashes'}, 'displayOrder': 0}, 'block123')
+        mock_db.collection.return_value.document.return_value.get.return_value = firestore_doc(None)
+        ordered_query = mock_db.collection.return_value.where.return_value.where.return_value.order_by.return_value
+        ordered_query.select.return_value.stream.return_value = [block_doc]
+        
+        response = client.get('/api/content/home')
+        
+        assert response.status_code == 200
+        blocks = response.get_json()['contentBlocks']
+        assert blocks == [{'id': 'block123', 'blockType': 'hero', 'blockName': 'Welcome',
+                           'content': {'title': 'Lashes'}, 'displayOrder': 0}]
+        assert 'createdBy' not in ordered_query.select.call_args.args[0]
+    
+    def test_get_page_content_cached_until_version_changes(self, mock_db, client, firestore_doc):
+        """Test warm reads skip the query until contentVersions moves on"""
+        version_ref = mock_db.collection.return_value.document.return_value
+        version_ref.get.return_value = firestore_doc({'version': 1}, 'home')
+        ordered_query = mock_db.collection.return_value.where.return_value.where.return_value.order_by.return_value
+        ordered_query.select.return_value.stream.return_value = []
+        
+        assert client.get('/api/content/home').status_code == 200
+        assert client.get('/api/content/home').status_code == 200
+        assert ordered_query.select.call_count == 1
+        
+        # Another instance bumped the version; the next read past the version TTL requeries
+        import main
+        main._content_version_cache.clear()
+        version_ref.get.return_value = firestore_doc({'version': 2}, 'home')
+        assert client.get('/api/content/home').status_code == 200
+        assert ordered_query.select.call_count == 2
+    
+    def test_create_content_block_bumps_version(self, admin_authenticated_client):
+        """Test a new block and its page version are committed together"""
+        client, mock_db, _ = admin_authenticated_client
+        mock_db.collection.return_value.document.return_value.id = 'block123'
+        
+        response = client.post('/api/content/home/blocks',
+                             headers=_ADMIN_AUTH,
+                             json={'blockType': 'hero', 'blockName': 'Welcome', 'content': {}})
+        
+        assert response.status_code == 201
+        assert response.get_json()['blockId'] == 'block123'
+        batch = mock_db.batch.return_value
+        assert batch.set.call_count == 2
+        assert batch.set.call_args.kwargs == {'merge': True}
+        batch.commit.assert_called_once()
+
+# =============================================================================
+# UTILITY ENDPOINT TESTS
+# =============================================================================
+
+class TestUtilityEndpoints:
+    
+    def test_initialize_database_single_batch(self, mock_db, client):
+        """Test default settings and services are written in one commit"""
+        response = client.post('/api/initialize')
+        
+        assert response.status_code == 200
+        batch = mock_db.batch.return_value
+        assert batch.set.call_count == 3  # settings + two services
+        batch.commit.assert_called_once()
+        mock_db.collection.return_value.add.assert_not_called()